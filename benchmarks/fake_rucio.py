@@ -0,0 +1,166 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Stand-ins for the rucio clients that serve a synthetic (or recorded) container,
+so that lookups can be timed without a grid proxy or a rucio server.
+"""
+import random
+import time
+
+from rucio.common.exception import DataIdentifierNotFound
+from servicex.did_finder.metalink import parse_metalink
+
+SITES = [
+    'root://eosatlas.cern.ch:1094//eos/atlas/atlasdatadisk/rucio/',
+    'root://xrootd.aglt2.org:1094//pnfs/aglt2.org/atlasdatadisk/rucio/',
+    'root://fax.mwt2.org:1094//pnfs/uchicago.edu/atlasdatadisk/rucio/',
+    'root://dcgftp.usatlas.bnl.gov:1094//pnfs/usatlas.bnl.gov/BNLT0D1/rucio/',
+    'root://ccxrdatlas.in2p3.fr:1094//pnfs/in2p3.fr/data/atlas/atlasdatadisk/rucio/',
+]
+
+SCOPE = 'data18_13TeV'
+CONTAINER = 'data18_13TeV.periodAllYear.physics_Main.PhysCont.DAOD_PHYS.grp18_v01_p4150'
+
+METALINK_HEAD = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+    '<metalink xmlns="urn:ietf:params:xml:ns:metalink">\n'
+METALINK_TAIL = '</metalink>\n'
+
+
+class FakeRucio:
+    def __init__(self, n_datasets=100, n_files=50, n_replicas=3, latency=0.0,
+                 latency_per_file=0.0, metalink=None, seed=1):
+        '''A container of `n_datasets` datasets with `n_files` files each.
+
+        Args:
+            n_datasets (int): Width of the container.
+            n_files (int): Files per dataset.
+            n_replicas (int): Replicas per file, at most the number of SITES.
+            latency (float): Seconds every call to the fake clients takes.
+            latency_per_file (float): Extra seconds per file returned by list_replicas.
+            metalink (str, optional): Recorded metalink reply, served as the
+                content of every dataset instead of synthetic files.
+            seed (int): Seed of the synthetic checksums, sizes and sites.
+        '''
+        self.latency = latency
+        self.latency_per_file = latency_per_file
+        self.datasets = [f'{SCOPE}.{i:08d}.physics_Main.deriv.DAOD_PHYS.r10258_p3399_tid{i}_00'
+                         for i in range(n_datasets)]
+        self.n_files = n_files
+        rnd = random.Random(seed)
+        # Replies are built up front, so building them is not part of the timings
+        self.files = {ds: metalink or self._make_files(rnd, ds, n_files, n_replicas)
+                      for ds in self.datasets}
+        self.file_lists = {ds: [
+            {'scope': f['identity'].split(':')[0], 'name': f['identity'].split(':')[1],
+             'bytes': f['size'], 'adler32': f['adler32'], 'events': None}
+            for f in parse_metalink(METALINK_HEAD + files + METALINK_TAIL)
+        ] for ds, files in self.files.items()}
+        self.calls = {}
+
+    @staticmethod
+    def _make_files(rnd, ds, n_files, n_replicas):
+        body = []
+        for i in range(n_files):
+            name = f'DAOD_PHYS.{ds.rsplit("_tid", 1)[1][:-3]}._{i:06d}.pool.root.1'
+            path = f'{SCOPE}/{rnd.randrange(256):02x}/{rnd.randrange(256):02x}/{name}'
+            urls = ''.join(
+                f'  <url location="SITE{p}" domain="wan" priority="{p + 1}" '
+                f'client_extract="false">{site}{path}</url>\n'
+                for p, site in enumerate(rnd.sample(SITES, n_replicas))
+            )
+            body.append(
+                f' <file name="{name}">\n'
+                f'  <parents>\n   <did>{SCOPE}:{ds}</did>\n'
+                f'   <did>{SCOPE}:{CONTAINER}</did>\n  </parents>\n'
+                f'  <identity>{SCOPE}:{name}</identity>\n'
+                f'  <hash type="adler32">{rnd.getrandbits(32):08x}</hash>\n'
+                f'  <size>{rnd.randrange(10**8, 5 * 10**9)}</size>\n'
+                f'  <glfn name="/atlas/rucio/{SCOPE}:{name}"></glfn>\n'
+                f'{urls} </file>\n'
+            )
+        return ''.join(body)
+
+    def _call(self, name, n_files=0):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        delay = self.latency + n_files * self.latency_per_file
+        if delay:
+            time.sleep(delay)
+
+    # DIDClient
+    def get_did(self, scope, name, dynamic=False):
+        self._call('get_did')
+        if name == CONTAINER:
+            return {'scope': scope, 'name': name, 'type': 'CONTAINER',
+                    'length': len(self.datasets)}
+        if name in self.files:
+            return {'scope': scope, 'name': name, 'type': 'DATASET', 'length': self.n_files}
+        raise DataIdentifierNotFound(f'{scope}:{name}')
+
+    def list_content(self, scope, name):
+        self._call('list_content')
+        return [{'scope': SCOPE, 'name': ds, 'type': 'DATASET'} for ds in self.datasets]
+
+    def list_files(self, scope, name, long=False):
+        self._call('list_files')
+        return iter(self.file_lists[name])
+
+    # ReplicaClient
+    def list_replicas(self, dids, **kwargs):
+        self._call('list_replicas', len(dids) * self.n_files)
+        return METALINK_HEAD + ''.join(self.files[d['name']] for d in dids) + METALINK_TAIL
+
+    # ScopeClient
+    def list_scopes(self):
+        self._call('list_scopes')
+        return [SCOPE, 'mc16_13TeV', 'user.kchoi']
+
+
+class FakeMemcacheClient:
+    '''Keeps serialized values in a dict, like memcached would, so that the
+    serde is part of the cache timings.'''
+
+    def __init__(self, serde):
+        self.serde = serde
+        self.values = {}
+        self.bytes_stored = 0
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            if key in self.values:
+                found[key] = self.serde.deserialize(key, *self.values[key])
+        return found
+
+    def set_many(self, values, expire=0, noreply=None):
+        for key, value in values.items():
+            self.values[key] = self.serde.serialize(key, value)
+            self.bytes_stored += len(self.values[key][0])
+        return []
+
+    def delete(self, key, noreply=None):
+        self.values.pop(key, None)
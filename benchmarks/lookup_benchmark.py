@@ -0,0 +1,218 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Times DID lookups against the stand-in rucio of fake_rucio.py. Run with:
+PYTHONPATH=src python benchmarks/lookup_benchmark.py
+
+For every scenario it reports the number of files, the total time, the
+throughput, the time until the first chunk of files was available and the
+peak memory allocated during the lookup.
+
+With --thresholds, the results are checked against the minimum throughput and
+maximum peak memory of each scenario in the given JSON file, and the script
+exits with an error if any of them is not met. See thresholds.json.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from fake_rucio import CONTAINER, SCOPE, FakeMemcacheClient, FakeRucio
+from serde_benchmark import bench
+
+from servicex.did_finder.cache import BinarySerde, JsonSerde, LRUCache, MemcacheCache
+from servicex.did_finder.lookup_request import LookupRequest
+from servicex.did_finder.rucio_adapter import RucioAdapter
+from servicex.did_finder.scope_index import ScopeIndex
+
+
+def measure(name, make_chunks, memory=True):
+    """
+    Consume the chunks of a lookup and collect its timings. The lookup is run
+    twice, since tracing allocations slows it down: once for the timings and
+    once for the peak memory.
+    :param make_chunks: function returning a new generator of the lookup chunks
+    :param memory: measure the peak memory, otherwise it is reported as 0
+    """
+    chunks = make_chunks()
+    start = time.perf_counter()
+    first = None
+    n_files = 0
+    for chunk in chunks:
+        if first is None:
+            first = time.perf_counter() - start
+        n_files += len(chunk)
+    duration = time.perf_counter() - start
+
+    peak = 0
+    if memory:
+        chunks = make_chunks()
+        tracemalloc.start()
+        try:
+            for chunk in chunks:
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {
+        'scenario': name,
+        'files': n_files,
+        'seconds': duration,
+        'files_per_second': n_files / duration if duration else 0.0,
+        'first_chunk_seconds': first or 0.0,
+        'peak_mb': peak / 1e6
+    }
+
+
+def run(args):
+    rucio = FakeRucio(args.datasets, args.files, args.replicas, args.latency,
+                      metalink=open(args.metalink).read() if args.metalink else None)
+    did = f'{SCOPE}:{CONTAINER}'
+
+    def adapter(report_logical_files=False):
+        return RucioAdapter(rucio, rucio, report_logical_files, threads=args.threads,
+                            batch_size=args.batch_size, scope_index=ScopeIndex(rucio))
+
+    def lookup(cache=None, stream=False):
+        return LookupRequest(did, adapter(), prefix='root://xcache.local//',
+                             stream=stream, cache=cache).lookup_files()
+
+    def cached_lookup(make_cache, stream=False):
+        'Lookup served by a cache that the same lookup has filled'
+        cache = make_cache()
+        for _ in lookup(cache):
+            pass
+        return lookup(cache, stream)
+
+    memory = not args.no_memory
+    results = [
+        measure('adapter', lambda: adapter().list_files_for_did(did), memory),
+        measure('adapter logical', lambda: adapter(True).list_files_for_did(did), memory),
+        measure('lookup', lambda: lookup(), memory),
+        measure('lookup stream', lambda: lookup(stream=True), memory),
+        measure('lookup lru miss', lambda: lookup(LRUCache()), memory),
+        measure('lookup lru hit', lambda: cached_lookup(LRUCache), memory),
+    ]
+    for serde in (JsonSerde(), BinarySerde()):
+        name = type(serde).__name__
+        results.append(measure(f'lookup {name} miss',
+                               lambda: lookup(MemcacheCache(FakeMemcacheClient(serde))),
+                               memory))
+        results.append(measure(f'lookup {name} hit',
+                               lambda: cached_lookup(
+                                   lambda: MemcacheCache(FakeMemcacheClient(serde)), True),
+                               memory))
+
+    files = next(lookup())
+    for serde in (JsonSerde(), BinarySerde()):
+        size, ser, de = bench(serde, files, 3)
+        results.append({
+            'scenario': f'serde {type(serde).__name__}',
+            'files': len(files),
+            'seconds': ser + de,
+            'files_per_second': len(files) / (ser + de),
+            'first_chunk_seconds': 0.0,
+            'peak_mb': 0.0,
+            'cache_bytes': size
+        })
+    return results
+
+
+# Arguments that have to match the ones the thresholds were set for
+SETUP_ARGS = ('datasets', 'files', 'replicas', 'latency', 'metalink', 'threads', 'batch_size')
+
+
+def check(results, args, thresholds):
+    """
+    Compare the results with the thresholds of their scenarios.
+    :param thresholds: dictionary with the 'args' the thresholds are for and,
+                       by scenario, 'min_files_per_second' and 'max_peak_mb'
+    :return: list of the thresholds that were not met
+    """
+    setup = {k: v for k, v in vars(args).items() if k in SETUP_ARGS}
+    expected = {k: v for k, v in thresholds['args'].items() if k in SETUP_ARGS}
+    if setup != expected:
+        return [f'The thresholds are for {expected}, not {setup}.']
+    failures = []
+    for r in results:
+        limits = thresholds['scenarios'].get(r['scenario'], {})
+        if r['files_per_second'] < limits.get('min_files_per_second', 0):
+            failures.append(f"{r['scenario']}: {r['files_per_second']:.0f} files/s, "
+                            f"below {limits['min_files_per_second']}")
+        if not args.no_memory and r['peak_mb'] > limits.get('max_peak_mb', float('inf')):
+            failures.append(f"{r['scenario']}: {r['peak_mb']:.1f} peak MB, "
+                            f"above {limits['max_peak_mb']}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets', type=int, default=200, help='Datasets in the container')
+    parser.add_argument('--files', type=int, default=100, help='Files per dataset')
+    parser.add_argument('--replicas', type=int, default=3, help='Replicas per file')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds each rucio call takes')
+    parser.add_argument('--metalink', help='Recorded metalink reply to serve for every dataset')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Do not measure the peak memory, which runs every lookup twice')
+    parser.add_argument('--thresholds',
+                        help='JSON file with the thresholds to check the results against')
+    args = parser.parse_args()
+
+    # Only the caches set up by the scenarios are used
+    os.environ.pop('CACHE_BACKEND', None)
+    os.environ.pop('MEMCACHE', None)
+
+    results = run(args)
+    print(f'{args.datasets} datasets x {args.files} files x {args.replicas} replicas, '
+          f'{args.latency}s latency, {args.threads} threads, batch size {args.batch_size}')
+    print(f"{'scenario':<26}{'files':>9}{'seconds':>10}{'files/s':>11}"
+          f"{'first chunk':>13}{'peak MB':>10}")
+    for r in results:
+        print(f"{r['scenario']:<26}{r['files']:>9}{r['seconds']:>10.3f}"
+              f"{r['files_per_second']:>11.0f}{r['first_chunk_seconds']:>13.3f}"
+              f"{r['peak_mb']:>10.1f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            failures = check(results, args, json.load(f))
+        for failure in failures:
+            print(f'Regression: {failure}')
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
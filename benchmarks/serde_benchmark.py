@@ -0,0 +1,89 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Compares the serializers used for cached lookup results. Run with:
+PYTHONPATH=src python benchmarks/serde_benchmark.py
+"""
+import argparse
+import random
+import timeit
+
+from servicex.did_finder.cache import BinarySerde, JsonSerde
+
+SITES = [
+    'root://eosatlas.cern.ch:1094//eos/atlas/atlasdatadisk/rucio/',
+    'root://xrootd.aglt2.org:1094//pnfs/aglt2.org/atlasdatadisk/rucio/',
+    'root://fax.mwt2.org:1094//pnfs/uchicago.edu/atlasdatadisk/rucio/',
+    'root://dcgftp.usatlas.bnl.gov:1094//pnfs/usatlas.bnl.gov/BNLT0D1/rucio/',
+    'root://ccxrdatlas.in2p3.fr:1094//pnfs/in2p3.fr/data/atlas/atlasdatadisk/rucio/',
+]
+
+
+def make_files(n_files, n_replicas, seed=1):
+    'Synthetic lookup result that looks like a DAOD_PHYS dataset'
+    rnd = random.Random(seed)
+    files = []
+    for i in range(n_files):
+        name = f'DAOD_PHYS.{21568817 + i // 1000}._{i:06d}.pool.root.1'
+        path = f'data18_13TeV/{rnd.randrange(256):02x}/{rnd.randrange(256):02x}/{name}'
+        files.append({
+            'adler32': f'{rnd.getrandbits(32):08x}',
+            'file_size': rnd.randrange(10**8, 5 * 10**9),
+            'file_events': 0,
+            'paths': [site + path for site in rnd.sample(SITES, n_replicas)]
+        })
+    return files
+
+
+def bench(serde, files, repeat):
+    data, flags = serde.serialize('key', files)
+    assert serde.deserialize('key', data, flags) == files
+    ser = min(timeit.repeat(lambda: serde.serialize('key', files), number=1, repeat=repeat))
+    de = min(timeit.repeat(lambda: serde.deserialize('key', data, flags), number=1, repeat=repeat))
+    return len(data), ser, de
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=50000)
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    files = make_files(args.files, args.replicas)
+    print(f'{args.files} files with {args.replicas} replicas each')
+    print(f"{'serde':<20}{'bytes':>12}{'serialize (s)':>16}{'deserialize (s)':>18}")
+    for name, serde in [('JsonSerde', JsonSerde()),
+                        ('BinarySerde', BinarySerde()),
+                        ('BinarySerde level 6', BinarySerde(level=6))]:
+        size, ser, de = bench(serde, files, args.repeat)
+        print(f'{name:<20}{size:>12}{ser:>16.3f}{de:>18.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -41,8 +41,8 @@ async def t1(scope, name):
     )
 
     count = 0
-    for laf in lookup_request.lookup_files():
-        count += 1
+    async for laf in lookup_request.lookup_files_async():
+        count += len(laf)
     print(f'found {count} files')
 
 loop = asyncio.get_event_loop()
@@ -28,26 +28,147 @@
 
 import argparse
 import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+import sys
+import time
 
 from rucio.client.didclient import DIDClient
 from rucio.client.replicaclient import ReplicaClient
+from servicex.did_finder.replica_ranking import create_ranker
 from servicex.did_finder.rucio_adapter import RucioAdapter
+from servicex.did_finder.rucio_calls import RucioCaller
+from servicex.did_finder.scope_index import ScopeIndex
 from servicex_did_finder_lib import add_did_finder_cnd_arguments, start_did_finder
+from servicex.did_finder.cache import get_cache
 from servicex.did_finder.lookup_request import LookupRequest
+from servicex.did_finder.metrics import start_metrics_server
+from servicex.did_finder.popularity import POPULARITY
+from servicex.did_finder.prewarm import Prewarmer
 
 
 def run_rucio_finder():
     '''Run the rucio finder
     '''
-    logger = logging.getLogger()
-
     # Parse the command line arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("--report-logical-files", action="store_true")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of replica lookups to run concurrently")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Number of datasets to look up with a single replica request")
+    parser.add_argument("--max-container-depth", type=int, default=10,
+                        help="Levels of nested containers that are expanded")
+    parser.add_argument("--stream", action="store_true",
+                        help="Send the files of each dataset as soon as it is resolved")
+    parser.add_argument("--scope-cache-file", default=None,
+                        help="File to keep the list of rucio scopes in between restarts")
+    parser.add_argument("--scope-refresh-interval", type=int, default=3600,
+                        help="Seconds between reloads of the list of rucio scopes")
+    parser.add_argument("--prefer-rses", default='',
+                        help="Comma separated RSEs whose replicas are listed first, in order")
+    parser.add_argument("--exclude-rses", default='',
+                        help="Comma separated RSEs whose replicas are left out")
+    parser.add_argument("--rse-stats-file", default=None,
+                        help="JSON file with measured latency and throughput of the RSEs, "
+                             "used to list the fastest replicas first")
+    parser.add_argument("--max-replicas", type=int, default=0,
+                        help="Maximum number of replicas reported per file, all if 0")
+    parser.add_argument("--rucio-retries", type=int, default=3,
+                        help="Retries of rucio calls that fail with a transient error")
+    parser.add_argument("--rucio-deadline", type=float, default=0,
+                        help="Seconds a rucio call may take including retries, no limit if 0. "
+                             "Also the timeout of each request to rucio")
+    parser.add_argument("--rucio-max-concurrency", type=int, default=64,
+                        help="Maximum number of concurrent calls to each rucio endpoint")
+    parser.add_argument("--rucio-latency-target", type=float, default=0,
+                        help="Seconds above which a rucio call lowers the concurrency "
+                             "limit of its endpoint, not used if 0")
+    parser.add_argument("--prewarm-top", type=int, default=0,
+                        help="Number of the most requested DIDs to keep in the cache")
+    parser.add_argument("--prewarm-watch-list", default=None,
+                        help="File with DIDs to keep in the cache, one per line")
+    parser.add_argument("--prewarm-budget", type=int, default=1000,
+                        help="Rucio calls a round of cache pre-warming may make")
+    parser.add_argument("--prewarm-interval", type=int, default=300,
+                        help="Seconds between rounds of cache pre-warming")
+    parser.add_argument("--prewarm-lead", type=int, default=600,
+                        help="Seconds before they expire at which cache entries are renewed")
+    parser.add_argument("--popularity-file", default=None,
+                        help="File to keep the request counts of DIDs in between restarts")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="Port to serve prometheus metrics on, not served if 0. Worker "
+                             "processes serve them on the following ports")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of finder processes consuming lookup requests")
     add_did_finder_cnd_arguments(parser)
 
     args = parser.parse_args()
 
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        run_worker(args)
+
+
+def run_workers(args):
+    '''Run args.workers finder processes, which share the lookup requests of
+    the queue. A worker that dies is replaced, unless it died right after it
+    started, which points to a problem that a new worker would run into as well.
+    '''
+    logger = logging.getLogger()
+    context = multiprocessing.get_context('spawn')
+    workers = {}
+    stopping = False
+
+    def start(index):
+        worker = context.Process(target=run_worker, args=(args, index),
+                                 name=f'did-finder-{index}')
+        worker.start()
+        workers[index] = (worker, time.monotonic())
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for worker, _ in workers.values():
+            worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f'Starting {args.workers} DID finder workers')
+    for index in range(args.workers):
+        start(index)
+
+    exit_code = 0
+    while workers:
+        multiprocessing.connection.wait([w.sentinel for w, _ in workers.values()], timeout=1)
+        for index, (worker, started) in list(workers.items()):
+            if worker.is_alive():
+                continue
+            worker.join()
+            del workers[index]
+            if stopping:
+                continue
+            if time.monotonic() - started < 10:
+                logger.error(f'Worker {index} exited with {worker.exitcode} right after '
+                             'it started, stopping the DID finder.')
+                exit_code = worker.exitcode or 1
+                stop(None, None)
+                continue
+            logger.warning(f'Worker {index} exited with {worker.exitcode}, replacing it.')
+            start(index)
+    sys.exit(exit_code)
+
+
+def run_worker(args, index=0):
+    '''Run a finder process. Every worker has its own rucio clients and cache
+    connections. Only the first one refreshes the scope list from rucio, the
+    others reload it from the scope cache file, and only the first one keeps
+    the cache warm.
+    '''
+    logger = logging.getLogger()
+
     prefix = args.prefix
 
     logger.info("ServiceX DID Finder starting up. "
@@ -56,10 +177,56 @@ def run_rucio_finder():
     if args.report_logical_files:
         logger.info("---- DID Finder Only Returning Logical Names, not replicas -----")
 
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port + index)
+
     # Initialize the finder
-    did_client = DIDClient()
-    replica_client = ReplicaClient()
-    rucio_adapter = RucioAdapter(did_client, replica_client, args.report_logical_files)
+    # Without it, a single request that hangs is only bounded by the timeout
+    # of the rucio client, the deadline is checked between attempts
+    timeout = args.rucio_deadline or None
+    did_client = DIDClient() if timeout is None else DIDClient(timeout=timeout)
+    replica_client = ReplicaClient() if timeout is None else ReplicaClient(timeout=timeout)
+    caller = RucioCaller(retries=args.rucio_retries, deadline=args.rucio_deadline,
+                         max_concurrency=args.rucio_max_concurrency,
+                         latency_target=args.rucio_latency_target)
+    scope_index = ScopeIndex(cache_file=args.scope_cache_file,
+                             refresh_interval=args.scope_refresh_interval, caller=caller,
+                             follow=index > 0 and args.scope_cache_file is not None,
+                             timeout=timeout)
+    ranker = create_ranker(prefer_rses=[r for r in args.prefer_rses.split(',') if r],
+                           exclude_rses=[r for r in args.exclude_rses.split(',') if r],
+                           stats_file=args.rse_stats_file,
+                           max_replicas=args.max_replicas)
+    rucio_adapter = RucioAdapter(did_client, replica_client, args.report_logical_files,
+                                 threads=args.threads, batch_size=args.batch_size,
+                                 scope_index=scope_index, ranker=ranker,
+                                 max_depth=args.max_container_depth, caller=caller)
+
+    # Every worker adds its counts to the file, the first ranks the DIDs it
+    # pre-warms from the counts of them all
+    POPULARITY.history_file = args.popularity_file
+    POPULARITY.load()
+    POPULARITY.start(args.prewarm_interval)
+    watch_list = []
+    if args.prewarm_watch_list and index == 0:
+        with open(args.prewarm_watch_list) as f:
+            watch_list = [line.strip() for line in f
+                          if line.strip() and not line.startswith('#')]
+    if watch_list or (args.prewarm_top and index == 0):
+        if get_cache():
+            # Pre-warming gets its own call layer, so its budget only counts its calls
+            prewarm_adapter = RucioAdapter(
+                did_client, replica_client, args.report_logical_files,
+                threads=args.threads, batch_size=args.batch_size, scope_index=scope_index,
+                ranker=ranker, max_depth=args.max_container_depth,
+                caller=RucioCaller(retries=args.rucio_retries, deadline=args.rucio_deadline,
+                                   max_concurrency=args.rucio_max_concurrency,
+                                   latency_target=args.rucio_latency_target))
+            Prewarmer(prewarm_adapter, get_cache(), watch_list=watch_list,
+                      top_n=args.prewarm_top, budget=args.prewarm_budget,
+                      lead=args.prewarm_lead, interval=args.prewarm_interval).start()
+        else:
+            logger.warning('Cache pre-warming needs a cache, see CACHE_BACKEND.')
 
     # Run the DID Finder
     try:
@@ -70,9 +237,10 @@ def run_rucio_finder():
                 did=did_name,
                 rucio_adapter=rucio_adapter,
                 prefix=prefix,
-                request_id=info['request-id']
+                request_id=info['request-id'],
+                stream=args.stream
             )
-            for file in lookup_request.lookup_files():
+            async for file in lookup_request.lookup_files_async():
                 yield file
 
         start_did_finder('rucio',
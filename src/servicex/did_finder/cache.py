@@ -0,0 +1,352 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+import logging
+import json
+import struct
+import sys
+import threading
+import time
+import zlib
+import base64
+from array import array
+from collections import OrderedDict
+from pymemcache.client.base import PooledClient
+from pymemcache.exceptions import MemcacheError
+from servicex.did_finder.metrics import CACHE_BYTES, CACHE_ERRORS
+from servicex.did_finder.tracing import span
+
+
+class JsonSerde(object):
+    def serialize(self, key, value):
+        cv = base64.b64encode(
+            zlib.compress(
+                json.dumps(value).encode('utf-8')
+            )
+        ).decode('ascii')
+        return cv, 1
+
+    def deserialize(self, key, value, flags):
+        return json.loads(zlib.decompress(base64.b64decode(value)))
+
+
+class BinarySerde(object):
+    '''Stores values as raw compressed bytes. Lists of files are stored column
+    by column (sizes, events and replica counts as packed integers, checksums
+    and paths as one block of text), anything else as JSON. The memcached flags
+    tell the layouts apart, and values written by `JsonSerde` can still be read.
+    '''
+    FLAG_JSON_BASE64 = 1
+    FLAG_JSON = 2
+    FLAG_FILES = 3
+
+    FILE_KEYS = {'adler32', 'file_size', 'file_events', 'paths'}
+    HEADER = struct.Struct('<BI')
+    LAYOUT_VERSION = 1
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def serialize(self, key, value):
+        files = self._pack_files(value)
+        if files is not None:
+            data, flags = zlib.compress(files, self.level), self.FLAG_FILES
+        else:
+            data = zlib.compress(json.dumps(value).encode('utf-8'), self.level)
+            flags = self.FLAG_JSON
+        CACHE_BYTES.labels('write').inc(len(data))
+        return data, flags
+
+    def deserialize(self, key, value, flags):
+        CACHE_BYTES.labels('read').inc(len(value))
+        if flags == self.FLAG_FILES:
+            return self._unpack_files(zlib.decompress(value))
+        if flags == self.FLAG_JSON:
+            return json.loads(zlib.decompress(value))
+        if flags == self.FLAG_JSON_BASE64:
+            return JsonSerde().deserialize(key, value, flags)
+        raise ValueError(f'Unknown cache value flags {flags}')
+
+    @staticmethod
+    def _little_endian(arr):
+        if sys.byteorder == 'big':
+            arr.byteswap()
+        return arr
+
+    def _pack_files(self, value):
+        'Returns None if value is not a list of files that can be packed'
+        if not isinstance(value, list) or not value:
+            return None
+        sizes = array('q')
+        events = array('q')
+        n_paths = array('I')
+        strings = []
+        paths = []
+        try:
+            for f in value:
+                if f.keys() != self.FILE_KEYS or not isinstance(f['adler32'], str):
+                    return None
+                sizes.append(f['file_size'])
+                events.append(f['file_events'])
+                n_paths.append(len(f['paths']))
+                strings.append(f['adler32'])
+                paths.extend(f['paths'])
+        except (AttributeError, TypeError, OverflowError):
+            return None
+        strings.extend(paths)
+        text = '\n'.join(strings)
+        if text.count('\n') != len(strings) - 1:
+            return None
+        return b''.join([
+            self.HEADER.pack(self.LAYOUT_VERSION, len(value)),
+            self._little_endian(sizes).tobytes(),
+            self._little_endian(events).tobytes(),
+            self._little_endian(n_paths).tobytes(),
+            text.encode('utf-8')
+        ])
+
+    def _unpack_files(self, data):
+        version, n = self.HEADER.unpack_from(data)
+        if version != self.LAYOUT_VERSION:
+            raise ValueError(f'Unknown cached file list layout {version}')
+        offset = self.HEADER.size
+        columns = []
+        for typecode in 'qqI':
+            column = array(typecode)
+            end = offset + n * column.itemsize
+            column.frombytes(data[offset:end])
+            columns.append(self._little_endian(column))
+            offset = end
+        sizes, events, n_paths = columns
+        strings = data[offset:].decode('utf-8').split('\n')
+        files = []
+        start = n
+        for i in range(n):
+            end = start + n_paths[i]
+            files.append({
+                'adler32': strings[i],
+                'file_size': sizes[i],
+                'file_events': events[i],
+                'paths': strings[start:end]
+            })
+            start = end
+        return files
+
+
+class CacheBackend:
+    '''Interface of the caches used to keep lookup results. A ttl of 0 means
+    that the entry does not expire.'''
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def set(self, key, value, ttl=0):
+        self.set_many({key: value}, ttl)
+
+    def get_many(self, keys):
+        raise NotImplementedError
+
+    def set_many(self, values, ttl=0):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    def __init__(self, max_size=1000000):
+        '''In-process cache that drops the least recently used entries once
+        the total size of the entries goes over `max_size`. The size of list
+        values is their length (so the number of files), other values count
+        as one.
+
+        Args:
+            max_size (int, optional): Maximum total size of the entries.
+        '''
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(value):
+        return len(value) if isinstance(value, list) else 1
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                value, expires = entry
+                if expires and expires < now:
+                    self._remove(key)
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = value
+        return found
+
+    def set_many(self, values, ttl=0):
+        expires = time.monotonic() + ttl if ttl else 0
+        with self._lock:
+            for key, value in values.items():
+                size = self._size(value)
+                if size > self.max_size:
+                    continue
+                self._remove(key)
+                self._entries[key] = (value, expires)
+                self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= self._size(entry[0])
+
+
+class MemcacheCache(CacheBackend):
+    def __init__(self, client):
+        '''Cache kept in memcached.
+
+        Args:
+            client: pymemcache client, normally a `PooledClient` shared by all requests.
+        '''
+        self.client = client
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    def get_many(self, keys):
+        try:
+            with span('memcache.get', keys=len(keys)):
+                return self.client.get_many(keys)
+        except (MemcacheError, OSError) as e:
+            self.logger.warning(f'Memcached get failed: {e}')
+            CACHE_ERRORS.labels('get').inc()
+            return {}
+
+    def set_many(self, values, ttl=0):
+        try:
+            with span('memcache.set', keys=len(values)):
+                self.client.set_many(values, ttl, noreply=True)
+        except (MemcacheError, OSError) as e:
+            self.logger.warning(f'Memcached set failed: {e}')
+            CACHE_ERRORS.labels('set').inc()
+
+    def delete(self, key):
+        try:
+            self.client.delete(key, noreply=True)
+        except (MemcacheError, OSError) as e:
+            self.logger.warning(f'Memcached delete failed: {e}')
+            CACHE_ERRORS.labels('delete').inc()
+
+
+class TieredCache(CacheBackend):
+    def __init__(self, near: CacheBackend, far: CacheBackend, near_ttl: int = 300):
+        '''Two level cache. Entries are looked up in `near` first, and entries
+        only found in `far` are copied into `near`. Writes go to both.
+
+        Args:
+            near (CacheBackend): Fast, usually in-process, cache.
+            far (CacheBackend): Shared cache.
+            near_ttl (int, optional): Lifetime in `near` of the entries copied
+                from `far`, whose remaining lifetime is not known.
+        '''
+        self.near = near
+        self.far = far
+        self.near_ttl = near_ttl
+
+    def get_many(self, keys):
+        found = self.near.get_many(keys)
+        missing = [k for k in keys if k not in found]
+        if missing:
+            far_found = self.far.get_many(missing)
+            if far_found:
+                self.near.set_many(far_found, self.near_ttl)
+                found.update(far_found)
+        return found
+
+    def set_many(self, values, ttl=0):
+        self.near.set_many(values, ttl)
+        self.far.set_many(values, ttl)
+
+    def delete(self, key):
+        self.near.delete(key)
+        self.far.delete(key)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def create_cache():
+    '''Build the cache configured by the environment:
+
+    CACHE_BACKEND: one of `lru`, `memcache` or `tiered` (LRU in front of memcached).
+        No cache is used if not set, unless MEMCACHE is `True`, which selects `memcache`.
+    CACHE_LRU_SIZE: maximum number of files kept in the LRU cache.
+    CACHE_LRU_TTL: seconds entries read from memcached are kept in the LRU cache
+        in `tiered` mode.
+    MEMCACHE_HOST: memcached server. Defaults to localhost.
+    MEMCACHE_POOL_SIZE: maximum number of connections to memcached.
+    '''
+    backend = os.getenv('CACHE_BACKEND', '')
+    if not backend and os.getenv('MEMCACHE') == 'True':
+        backend = 'memcache'
+    if not backend:
+        return None
+    if backend not in ('lru', 'memcache', 'tiered'):
+        raise ValueError(f'Unknown cache backend {backend}')
+
+    lru = memcache = None
+    if backend in ('lru', 'tiered'):
+        lru = LRUCache(int(os.getenv('CACHE_LRU_SIZE', '1000000')))
+    if backend in ('memcache', 'tiered'):
+        memcache = MemcacheCache(PooledClient(
+            os.getenv('MEMCACHE_HOST', 'localhost'),
+            serde=BinarySerde(),
+            max_pool_size=int(os.getenv('MEMCACHE_POOL_SIZE', '16'))
+        ))
+    if backend == 'tiered':
+        return TieredCache(lru, memcache, int(os.getenv('CACHE_LRU_TTL', '300')))
+    return lru or memcache
+
+
+def get_cache():
+    '''The cache shared by all the lookup requests of this process'''
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = create_cache() or False
+    return _cache or None
@@ -0,0 +1,145 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from servicex.did_finder.cache import BinarySerde
+
+
+class CheckpointStore:
+    def __init__(self, path, max_age=86400, timeout=30.0):
+        """
+        Keeps the files of the datasets a lookup has already resolved in an
+        SQLite database, so a lookup interrupted by a restart of the finder
+        can resume from the datasets it had not resolved yet. Checkpoints are
+        keyed on the request id and the DID.
+
+        :param path: database file, `:memory:` keeps it in memory.
+        :param max_age: seconds after which checkpoints of lookups that never
+                        finished are dropped.
+        :param timeout: seconds to wait for the database while another process,
+                        e.g. another worker, writes to it.
+
+        Checkpoints are best effort, database errors are logged and the lookup
+        goes on without them.
+        """
+        self.path = path
+        self.max_age = max_age
+        self.serde = BinarySerde()
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+        self._db = sqlite3.connect(path, timeout=timeout, check_same_thread=False,
+                                   isolation_level=None)
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoints ('
+                ' request_id TEXT, did TEXT, dataset TEXT, created REAL,'
+                ' flags INTEGER, files BLOB,'
+                ' PRIMARY KEY (request_id, did, dataset))'
+            )
+        self.prune()
+
+    def load(self, request_id, did):
+        """
+        The datasets of the lookup that were checkpointed.
+        :return: dictionary of the dataset keys and their lists of files
+        """
+        try:
+            with self._lock:
+                rows = self._db.execute(
+                    'SELECT dataset, flags, files FROM checkpoints WHERE request_id=? AND did=?',
+                    (request_id, did)).fetchall()
+        except sqlite3.Error as e:
+            self.logger.warning(f'Reading checkpoints failed: {e}')
+            return {}
+        return {ds: self.serde.deserialize(ds, files, flags) for ds, flags, files in rows}
+
+    def save(self, request_id, did, dataset, files):
+        """
+        Checkpoint a resolved dataset of the lookup.
+        :param dataset: key of the dataset
+        :param files: list (or `FileTable`) of the files of the dataset
+        """
+        data, flags = self.serde.serialize(dataset, list(files))
+        try:
+            with self._lock:
+                self._db.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?)',
+                                 (request_id, did, dataset, time.time(), flags, data))
+        except sqlite3.Error as e:
+            self.logger.warning(f'Saving a checkpoint failed: {e}')
+
+    def clear(self, request_id, did):
+        "Drop the checkpoints of a lookup that has finished"
+        try:
+            with self._lock:
+                self._db.execute('DELETE FROM checkpoints WHERE request_id=? AND did=?',
+                                 (request_id, did))
+        except sqlite3.Error as e:
+            self.logger.warning(f'Dropping checkpoints failed: {e}')
+
+    def prune(self):
+        try:
+            with self._lock:
+                n = self._db.execute('DELETE FROM checkpoints WHERE created<?',
+                                     (time.time() - self.max_age,)).rowcount
+        except sqlite3.Error as e:
+            self.logger.warning(f'Pruning checkpoints failed: {e}')
+            return
+        if n:
+            self.logger.info(f'Dropped {n} checkpoints of lookups that did not finish.')
+
+
+_checkpoints = None
+_checkpoints_lock = threading.Lock()
+
+
+def get_checkpoints():
+    '''The checkpoint store shared by all the lookup requests of this process,
+    in the file named by CHECKPOINT_DB. None if it is not set. Checkpoints are
+    dropped after CHECKPOINT_MAX_AGE seconds. None as well if the database
+    cannot be opened, the lookups then run without checkpoints.'''
+    global _checkpoints
+    with _checkpoints_lock:
+        if _checkpoints is None:
+            path = os.getenv('CHECKPOINT_DB')
+            _checkpoints = False
+            if path:
+                try:
+                    _checkpoints = CheckpointStore(
+                        path, int(os.getenv('CHECKPOINT_MAX_AGE', '86400')))
+                except sqlite3.Error as e:
+                    logger = logging.getLogger(__name__)
+                    logger.addHandler(logging.NullHandler())
+                    logger.warning(f'Opening the checkpoint database {path} failed, '
+                                   f'lookups run without checkpoints: {e}')
+    return _checkpoints or None
@@ -0,0 +1,229 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import logging
+import threading
+
+
+class Flight:
+    '''A lookup in progress. Chunks are kept until every reader has read them,
+    and the producer waits while the slowest reader is `max_pending` chunks
+    behind. Readers can only be added while none of the chunks was dropped,
+    and while the flight is `shared`.'''
+
+    def __init__(self, max_pending=16):
+        self.chunks = []
+        # Position in the lookup of the first chunk still kept
+        self.base = 0
+        self.done = False
+        self.error = None
+        self.max_pending = max_pending
+        self.shared = True
+        # Position of the next chunk of each reader, by id of the reader
+        self._positions = {}
+        self._cond = threading.Condition()
+
+    def reader(self):
+        "Iterator over all the chunks, None if some of them were dropped already"
+        with self._cond:
+            if self.base or not self.shared:
+                return None
+            reader = FlightReader(self)
+            self._positions[id(reader)] = 0
+            return reader
+
+    def publish(self, chunk):
+        with self._cond:
+            while self._positions and len(self.chunks) >= self.max_pending:
+                self._cond.wait()
+            if self._positions:
+                self.chunks.append(chunk)
+            else:
+                # Nobody reads the chunks, the lookup only runs for its side effects
+                self.base += 1
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    def wait(self):
+        "Block until the lookup is over, raises its error if it failed"
+        with self._cond:
+            while not self.done:
+                self._cond.wait()
+            if self.error is not None:
+                raise self.error
+
+    def _next(self, reader):
+        with self._cond:
+            i = self._positions.get(id(reader))
+            if i is None:
+                raise StopIteration
+            while i >= self.base + len(self.chunks) and not self.done:
+                self._cond.wait()
+            if i < self.base + len(self.chunks):
+                self._positions[id(reader)] = i + 1
+                chunk = self.chunks[i - self.base]
+                self._trim()
+                return chunk
+            self._close(reader)
+            if self.error is not None:
+                raise self.error
+            raise StopIteration
+
+    def _close(self, reader):
+        with self._cond:
+            if self._positions.pop(id(reader), None) is not None:
+                self._trim()
+
+    def _trim(self):
+        "Drop the chunks every reader has read"
+        first = min(self._positions.values(), default=self.base + len(self.chunks))
+        if first > self.base:
+            del self.chunks[:first - self.base]
+            self.base = first
+            self._cond.notify_all()
+
+
+class FlightReader:
+    '''Iterator over the chunks of a `Flight`. Closing it, or dropping it,
+    tells the flight its chunks are no longer needed.'''
+
+    def __init__(self, flight):
+        self._flight = flight
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._flight._next(self)
+
+    def close(self):
+        self._flight._close(self)
+
+    def __del__(self):
+        self.close()
+
+
+class SingleFlight:
+    def __init__(self, max_pending=16):
+        '''Runs at most one lookup per key at a time. Callers asking for a key
+        whose lookup is already running get its chunks instead of starting
+        another one, as long as the lookup still has all of them.
+
+        Args:
+            max_pending (int, optional): Number of chunks a lookup runs ahead of
+                its slowest reader. Defaults to 16.
+        '''
+        self.max_pending = max_pending
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    def join(self, key, produce, fallback=None, shared=True):
+        """
+        Get the chunks of the lookup for key, starting it if it is not running.
+        The lookup runs in its own thread, so it completes (and e.g. fills the
+        cache) even if the callers stop reading, once they close their iterator.
+        :param key: identifies equivalent lookups
+        :param produce: function returning a generator of the chunks
+        :param fallback: function returning the chunks of a lookup that is over,
+                         e.g. from a cache it fills, or None if it has not got
+                         them. Callers that come too late to get all the chunks
+                         of the running lookup wait for it and use the fallback,
+                         another lookup is started if there is none.
+        :param shared: if False, a lookup started by this call cannot be joined,
+                       other callers are treated as if they came too late.
+        :return: tuple of an iterator over the chunks and whether this call
+                 started the lookup. Close the iterator if it is not read to
+                 the end, the lookup waits for its readers otherwise.
+        """
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                reader = flight.reader() if flight is not None else None
+                if reader is not None:
+                    return reader, False
+                if flight is None or fallback is None:
+                    if flight is not None:
+                        self.logger.info(f'Lookup of {key} is too far along to join, '
+                                         'starting another.')
+                    flight = Flight(self.max_pending)
+                    reader = flight.reader()
+                    flight.shared = shared
+                    self._flights[key] = flight
+                    break
+
+            self.logger.info(f'Lookup of {key} is too far along to join, waiting for it.')
+            try:
+                flight.wait()
+            except Exception:
+                pass
+            chunks = fallback()
+            if chunks is not None:
+                return chunks, False
+
+        threading.Thread(target=self._run, args=(key, flight, produce),
+                         name=f'lookup-{key}', daemon=True).start()
+        return reader, True
+
+    def start(self, key, produce):
+        """
+        Run the lookup for key in the background, for its side effects only,
+        unless a lookup of key is already running. Callers that join it later
+        wait for it and use their fallback.
+        :return: whether the lookup was started
+        """
+        with self._lock:
+            if key in self._flights:
+                return False
+            flight = Flight(self.max_pending)
+            self._flights[key] = flight
+        threading.Thread(target=self._run, args=(key, flight, produce),
+                         name=f'lookup-{key}', daemon=True).start()
+        return True
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._flights
+
+    def _run(self, key, flight, produce):
+        error = None
+        try:
+            for chunk in produce():
+                flight.publish(chunk)
+        except Exception as e:
+            error = e
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.finish(error)
@@ -0,0 +1,154 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+from array import array
+from operator import itemgetter
+
+
+class PrefixTable:
+    '''Interns the site part of replica urls. Each distinct prefix is stored
+    once and referred to by its index.'''
+
+    def __init__(self):
+        self.prefixes = []
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def intern(self, prefix):
+        prefix_id = self._ids.get(prefix)
+        if prefix_id is None:
+            with self._lock:
+                prefix_id = self._ids.get(prefix)
+                if prefix_id is None:
+                    prefix_id = len(self.prefixes)
+                    self.prefixes.append(prefix)
+                    self._ids[prefix] = prefix_id
+        return prefix_id
+
+
+# Shared by all file tables, there is only a handful of storage endpoints
+PREFIXES = PrefixTable()
+
+
+def split_url(url):
+    """
+    Split a replica url into the part that is the same for all files of a storage
+    endpoint and the rest. Rucio paths are deterministic below `/rucio/`, so
+    the rest is usually the same for all the replicas of a file.
+    :return: tuple of prefix and path
+    """
+    cut = url.find('/rucio/')
+    if cut >= 0:
+        cut += len('/rucio/')
+    else:
+        start = url.find('://')
+        cut = url.find('/', start + 3) if start >= 0 else -1
+        if cut < 0:
+            return '', url
+        while url.startswith('/', cut):
+            cut += 1
+    return url[:cut], url[cut:]
+
+
+class FileTable:
+    '''Compact list of the files of a dataset. Columns are kept in arrays,
+    replica paths as an interned site prefix plus the rest of the path.
+    Iterating over the table or `to_dicts` give the files as the usual
+    dictionaries with keys "adler32", "file_size", "file_events" and "paths".
+    '''
+    __slots__ = ('adler32', 'odd_adler32', 'sizes', 'path_ends', 'prefix_ids', 'suffixes')
+
+    def __init__(self):
+        self.adler32 = array('L')
+        # checksums that are not 8 digit hex strings, by file index
+        self.odd_adler32 = {}
+        self.sizes = array('q')
+        self.path_ends = array('L')
+        self.prefix_ids = array('L')
+        self.suffixes = []
+
+    def append(self, adler32, file_size, paths):
+        try:
+            value = int(adler32, 16)
+            if f'{value:08x}' != adler32:
+                raise ValueError(adler32)
+        except (TypeError, ValueError):
+            self.odd_adler32[len(self.sizes)] = adler32
+            value = 0
+        self.adler32.append(value)
+        self.sizes.append(file_size)
+        suffixes = {}
+        for url in paths:
+            prefix, suffix = split_url(url)
+            self.prefix_ids.append(PREFIXES.intern(prefix))
+            # replicas usually share the path, keep a single copy of it
+            self.suffixes.append(suffixes.setdefault(suffix, suffix))
+        self.path_ends.append(len(self.suffixes))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def total_size(self):
+        return sum(self.sizes)
+
+    def total_replicas(self):
+        return len(self.suffixes)
+
+    def __iter__(self):
+        return iter(self.to_dicts())
+
+    def to_dicts(self, prefix=''):
+        "Materialize the files as dictionaries, with prefix added to all the paths"
+        sites = [prefix + p for p in PREFIXES.prefixes]
+        prefix_ids, suffixes = self.prefix_ids, self.suffixes
+        files = []
+        start = 0
+        for i, end in enumerate(self.path_ends):
+            files.append({
+                'adler32': self.odd_adler32[i] if i in self.odd_adler32
+                else f'{self.adler32[i]:08x}',
+                'file_size': self.sizes[i],
+                'file_events': 0,
+                'paths': [sites[prefix_ids[j]] + suffixes[j] for j in range(start, end)]
+            })
+            start = end
+        return files
+
+
+def file_totals(files):
+    """
+    Number of files, their total size and total number of replicas, summed
+    over the columns of a `FileTable`, or over a list of file dictionaries
+    without building any per-file intermediate values.
+    :return: tuple of the three totals
+    """
+    if isinstance(files, FileTable):
+        return len(files), files.total_size(), files.total_replicas()
+    return (len(files),
+            sum(map(itemgetter('file_size'), files)),
+            sum(map(len, map(itemgetter('paths'), files))))
@@ -25,34 +25,48 @@
 # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import asyncio
+import collections
 import os
 import logging
+import itertools
 import json
-import zlib
-import base64
+import time
+import uuid
 from datetime import datetime
+from rucio.common.exception import DataIdentifierNotFound
 from servicex.did_finder.rucio_adapter import RucioAdapter
-from pymemcache.client.base import Client
+from servicex.did_finder.cache import CacheBackend, get_cache
+from servicex.did_finder.checkpoint import CheckpointStore, get_checkpoints
+from servicex.did_finder.coalesce import SingleFlight
+from servicex.did_finder.file_table import FileTable, file_totals
+from servicex.did_finder.metrics import CACHE_LOOKUPS, LOOKUP_FILES, LOOKUP_FILES_PER_SECOND, \
+    LOOKUP_SECONDS, LOOKUPS_IN_FLIGHT
+from servicex.did_finder.popularity import POPULARITY
+from servicex.did_finder.profiler import LookupProfiler
+from servicex.did_finder.tracing import attach, attached, span, start_trace
 
+# Version of the layout of cached results, entries of other versions are ignored
+CACHE_FORMAT_VERSION = 2
+# Number of chunks of a cached result that are fetched with one request
+CHUNK_READ_BATCH = 16
+# Number of datasets that are looked up in the cache with one request
+DATASET_READ_BATCH = 100
+# Number of chunks a shared rucio lookup runs ahead of its slowest reader
+FLIGHT_MAX_PENDING = 16
 
-class JsonSerde(object):
-    def serialize(self, key, value):
-        cv = base64.b64encode(
-            zlib.compress(
-                json.dumps(value).encode('utf-8')
-            )
-        ).decode('ascii')
-        return cv, 1
-
-    def deserialize(self, key, value, flags):
-        return json.loads(zlib.decompress(base64.b64decode(value)))
+# Rucio lookups in progress in this process, shared by identical requests
+FLIGHTS = SingleFlight(FLIGHT_MAX_PENDING)
 
 
 class LookupRequest:
     def __init__(self, did: str,
                  rucio_adapter: RucioAdapter,
                  prefix: str = '',
-                 request_id: str = 'bogus-id'):
+                 request_id: str = 'bogus-id',
+                 stream: bool = False,
+                 cache: CacheBackend = None,
+                 checkpoints: CheckpointStore = None):
         '''Create the `LookupRequest` object that is responsible for returning
         lists of files. Processes things in chunks.
 
@@ -62,29 +76,391 @@ class LookupRequest:
             prefix (str, optional): Prefix for xcache use. Defaults to ''.
             request_id (str, optional): ServiceX Request ID that requested this DID.
                 Defaults to 'bogus-id'.
+            stream (bool, optional): Yield the files of each dataset as soon as it
+                is resolved instead of a single list at the end. Defaults to False.
+            cache (CacheBackend, optional): Cache for the lookup results. Defaults
+                to the cache configured by the environment, see `create_cache`.
+            checkpoints (CheckpointStore, optional): Store of the datasets resolved
+                so far, to resume the lookup after a restart. Defaults to the store
+                configured by the environment, see `get_checkpoints`.
         '''
         self.did = did
         self.prefix = prefix
         self.rucio_adapter = rucio_adapter
         self.request_id = request_id
+        self.stream = stream
+        # Where the files came from, 'cache' or 'rucio'
+        self.source = None
+        # When the cached result that was read was stored
+        self.cached_at = None
+        # Root span of the lookup, while lookup_files runs
+        self.trace = None
 
         # set logging to a null handler
         self.logger = logging.getLogger(__name__)
         self.logger.addHandler(logging.NullHandler())
-        if os.getenv("MEMCACHE") == 'True':
-            self.mcclient = Client('localhost', serde=JsonSerde())
+        self.cache = cache if cache is not None else get_cache()
+        self.checkpoints = checkpoints if checkpoints is not None else get_checkpoints()
         self.ttl = int(os.getenv("MEMCACHE_TTL", '3600'))
+        self.chunk_size = int(os.getenv("CACHE_CHUNK_SIZE", '1000'))
+        self.dataset_ttl = int(os.getenv("MEMCACHE_DATASET_TTL", str(self.ttl)))
+        # Cached results older than this are served, but refreshed in the background
+        self.soft_ttl = int(os.getenv("MEMCACHE_SOFT_TTL", '0'))
+        # Lookups that found no files are cached for a short time only
+        self.negative_ttl = int(os.getenv("MEMCACHE_NEGATIVE_TTL", '60'))
 
     def getCachedResults(self):
-        res = self.mcclient.get(self.did)
-        return res
+        """
+        Read the cached files of the DID. Large results are stored as a manifest
+        under the DID plus numbered chunks, which are read a few at a time.
+        :return: generator of the cached lists of files in the order they were
+                 stored, or None if the DID is not (completely) in the cache.
+        """
+        manifest = self._get_manifest()
+        if manifest is None:
+            return None
+        keys = [f"{manifest['token']}:{i}" for i in range(manifest.get('chunks', 0))]
+        # Read the first chunks right away, so that the common case of a
+        # partially evicted entry is a plain miss.
+        first = self._get_chunks(keys[:CHUNK_READ_BATCH]) if keys else []
+        if first is None:
+            self.logger.warning('Cached result is incomplete.')
+            return None
+        if 'negative' in manifest:
+            self.logger.info(f"Cache hit. Lookup failed: {manifest['negative']}")
+            return self._replay_negative(manifest, first, keys[CHUNK_READ_BATCH:])
+        self.logger.info(f"Cache hit. Found {manifest['n_files']} files")
+        self.cached_at = manifest.get('created')
+        return self._read_chunks(first, keys[CHUNK_READ_BATCH:])
+
+    def setNegativeResult(self, outcome, message=None, result=()):
+        """
+        Cache the outcome of a lookup that found no (or not all) files, for
+        `negative_ttl` seconds, so retries of a bad DID do not go back to rucio.
+        :param outcome: 'not_found', 'empty' or 'missing_replicas'
+        :param message: message of the error the lookup raised, if any
+        :param result: lists of the files the lookup yielded before the error,
+                       they are replayed before it is raised again.
+        """
+        if not self.cache or not self.negative_ttl:
+            return
+        token, n_chunks, n_files = self._set_chunks(result, self.negative_ttl)
+        now = time.time()
+        # The expiry is checked when the entry is read, as a tier of the cache
+        # may keep it for longer than its TTL
+        self.cache.set(self.did, {
+            'version': CACHE_FORMAT_VERSION,
+            'negative': outcome,
+            'message': message,
+            'token': token,
+            'chunks': n_chunks,
+            'n_files': n_files,
+            'created': now,
+            'expires': now + self.negative_ttl
+        }, self.negative_ttl)
+
+    def _get_manifest(self):
+        "The cached manifest of the DID, None if there is none or it has expired"
+        manifest = self.cache.get(self.did)
+        if not isinstance(manifest, dict) or manifest.get('version') != CACHE_FORMAT_VERSION:
+            return None
+        if manifest.get('expires', float('inf')) <= time.time():
+            return None
+        return manifest
+
+    def _replay_negative(self, manifest, first, keys):
+        yield from self._read_chunks(first, keys)
+        if manifest['message'] is not None:
+            raise ValueError(manifest['message'])
+
+    def _get_chunks(self, keys):
+        found = self.cache.get_many(keys)
+        if len(found) < len(keys):
+            return None
+        return [found[k] for k in keys]
+
+    def _read_chunks(self, first, keys):
+        yield from first
+        for start in range(0, len(keys), CHUNK_READ_BATCH):
+            chunks = self._get_chunks(keys[start:start + CHUNK_READ_BATCH])
+            if chunks is None:
+                self.cache.delete(self.did)
+                raise ValueError(f'Cached result for {self.did} is incomplete. '
+                                 'It has been dropped, please retry.')
+            yield from chunks
+
+    def setCachedResults(self, result, key=None, ttl=None):
+        """
+        Store the files of the DID as chunks of `chunk_size` files plus a manifest,
+        so that no single cache item goes over the memcached item size limit.
+        :param result: lists (or `FileTable`s) of files without the prefix.
+        :param key: key of the manifest, defaults to the DID.
+        :param ttl: lifetime of the entry, defaults to `ttl`.
+        """
+        key = key or self.did
+        ttl = ttl or self.ttl
+        token, n_chunks, n_files = self._set_chunks(result, ttl)
+        # The manifest goes last, so it is never seen without its chunks
+        self.cache.set(key, {
+            'version': CACHE_FORMAT_VERSION,
+            'token': token,
+            'chunks': n_chunks,
+            'n_files': n_files,
+            'created': time.time()
+        }, ttl)
+
+    def _set_chunks(self, result, ttl):
+        ":return: tuple of the token of the chunks, their number and the number of files"
+        token = uuid.uuid4().hex
+        n_files = 0
+        n_chunks = 0
+        chunks = {}
+        chunk = []
+        for af in itertools.chain.from_iterable(result):
+            chunk.append(af)
+            n_files += 1
+            if len(chunk) == self.chunk_size:
+                chunks[f'{token}:{n_chunks}'] = chunk
+                n_chunks += 1
+                chunk = []
+                if len(chunks) == CHUNK_READ_BATCH:
+                    self.cache.set_many(chunks, ttl)
+                    chunks = {}
+        if chunk:
+            chunks[f'{token}:{n_chunks}'] = chunk
+            n_chunks += 1
+        if chunks:
+            self.cache.set_many(chunks, ttl)
+        return token, n_chunks, n_files
+
+    @staticmethod
+    def dataset_key(ds):
+        return f'dataset:{ds[0]}:{ds[1]}'
+
+    def getCachedDatasets(self, datasets):
+        """
+        Look the datasets up in the dataset level of the cache.
+        :param datasets: list of [scope, name] of the datasets
+        :return: generator of tuples of the dataset and the list of its files,
+                 or None if the dataset is not (completely) in the cache.
+        """
+        for start in range(0, len(datasets), DATASET_READ_BATCH):
+            batch = datasets[start:start + DATASET_READ_BATCH]
+            found = self.cache.get_many([self.dataset_key(ds) for ds in batch])
+            for ds in batch:
+                entry = found.get(self.dataset_key(ds))
+                if isinstance(entry, dict) and entry.get('version') == CACHE_FORMAT_VERSION:
+                    chunks = self._get_chunks([f"{entry['token']}:{i}"
+                                               for i in range(entry['chunks'])])
+                    entry = list(itertools.chain.from_iterable(chunks)) if chunks else None
+                yield ds, entry if isinstance(entry, list) else None
+
+    def setCachedDataset(self, ds, files):
+        """
+        Store the files of a dataset in the dataset level of the cache. Small
+        datasets are stored as a single list of files, larger ones like the
+        results of a DID.
+        """
+        if len(files) > self.chunk_size:
+            self.setCachedResults([files], self.dataset_key(ds), self.dataset_ttl)
+        else:
+            self.cache.set(self.dataset_key(ds), list(files), self.dataset_ttl)
+
+    def lookup_chunks(self):
+        """
+        Lists (or `FileTable`s) of files of the DID without the prefix, from the
+        cache if possible, otherwise from rucio, in which case the cache is filled.
+        """
+        cachedResults = None
+        if self.cache:
+            with span('cache.read', parent=self.trace):
+                cachedResults = self.getCachedResults()
+            CACHE_LOOKUPS.labels('miss' if cachedResults is None else 'hit').inc()
+
+        if cachedResults is not None:
+            self.source = 'cache'
+            if self.is_stale():
+                self.start_refresh()
+            yield from cachedResults
+            return
 
-    def setCachedResults(self, result):
-        self.mcclient.set(self.did, result, self.ttl, True)
+        self.source = 'rucio'
+        chunks, leader = FLIGHTS.join(self.flight_key(), self.resolve,
+                                      self.getCachedResults if self.cache else None)
+        if not leader:
+            self.logger.info('Joining the lookup of the same DID already in progress.')
+        yield from chunks
+
+    def cache_age(self):
+        "Seconds since the cached result of the DID was stored, None if there is none"
+        manifest = self._get_manifest() if self.cache else None
+        if manifest is None:
+            return None
+        return time.time() - manifest.get('created', 0)
+
+    def is_stale(self):
+        "Whether the cached result that was read is past the soft TTL"
+        if not self.soft_ttl or self.cached_at is None:
+            return False
+        return time.time() - self.cached_at > self.soft_ttl
+
+    def start_refresh(self):
+        """
+        Resolve the DID from rucio again in the background and replace the
+        cached result, unless a lookup of the DID is already running. Stale
+        hits while the refresh runs are served from the cache and do not
+        start another one.
+        """
+        if FLIGHTS.start(self.flight_key(), self.refresh):
+            CACHE_LOOKUPS.labels('stale').inc()
+            self.logger.info('Cached result is stale. Refreshing it in the background.')
+
+    def refresh(self):
+        "Chunks of a background refresh, which bypasses the dataset level of the cache"
+        try:
+            yield from self.resolve(use_dataset_cache=False, negative_cache=False)
+        except Exception:
+            self.logger.exception(f'Background refresh of {self.did} failed.')
+            raise
+
+    def flight_key(self):
+        """
+        Key of the rucio lookups that give the same files as this one. The prefix
+        is added to copies of the files, so it does not need to be part of it.
+        """
+        parsed_did = self.rucio_adapter.parse_did(self.did.strip())
+        did = f"{parsed_did['scope']}:{parsed_did['name']}" \
+            if isinstance(parsed_did, dict) else self.did.strip()
+        return did, bool(getattr(self.rucio_adapter, 'report_logical_files', False))
+
+    def resolve(self, use_dataset_cache=True, negative_cache=True):
+        """
+        Lists (or `FileTable`s) of files of the DID from rucio. Datasets that an
+        interrupted run of this request checkpointed, and, with a cache, the
+        datasets in the dataset level of the cache are not resolved again.
+        Fills both levels of the cache, and checkpoints the datasets as they
+        are resolved until the lookup is complete.
+        :param use_dataset_cache: read datasets from the cache and the
+                                  checkpoints, turned off to refresh them all.
+        :param negative_cache: cache lookups that find no files, turned off when
+                               the result of the DID in the cache should be kept.
+        """
+        with span('resolve', parent=self.trace, did=self.did):
+            yield from self._resolve(use_dataset_cache, negative_cache)
+
+    def _resolve(self, use_dataset_cache, negative_cache):
+        self.logger.info('Cache miss. Doing Rucio lookup.')
+        checkpoints = self.checkpoints if use_dataset_cache else None
+        if not self.cache and not checkpoints:
+            yield from self.rucio_adapter.list_files_for_did(self.did)
+            return
+
+        full_file_list = []
+        done = checkpoints.load(self.request_id, self.did) if checkpoints else {}
+        if done:
+            self.logger.info(f'Resuming the lookup, {len(done)} datasets were resolved before.')
+            for files in done.values():
+                full_file_list.append(files)
+                yield files
+
+        # Datasets are looked up in the cache as the DID is expanded, and the
+        # ones that are not there are resolved while the expansion goes on
+        expanded = []
+        hits = collections.deque()
+        misses = self._lookup_datasets(self._expand(done, expanded), use_dataset_cache, hits)
+        n_resolved = 0
+        try:
+            first = next(misses, None)
+            yield from self._drain(hits, full_file_list)
+            if first is not None:
+                for ds, files, no_replica_files in self.rucio_adapter.list_files_by_dataset(
+                        itertools.chain([first], misses), self.did):
+                    # Datasets with missing replicas are looked up again next time
+                    if not no_replica_files:
+                        if self.cache:
+                            self.setCachedDataset(ds, files)
+                        if checkpoints:
+                            checkpoints.save(self.request_id, self.did,
+                                             self.dataset_key(ds), files)
+                    n_resolved += 1
+                    full_file_list.append(files)
+                    yield files
+                    yield from self._drain(hits, full_file_list)
+        except DataIdentifierNotFound:
+            # Only a missing DID is an empty result, not a partial expansion
+            if expanded:
+                raise
+            self.logger.warning(f"{self.did} not found")
+            if negative_cache:
+                self.setNegativeResult('not_found')
+            return
+        except ValueError as e:
+            # Raised once all datasets are resolved, if files had no replicas
+            yield from self._drain(hits, full_file_list)
+            if negative_cache:
+                self.setNegativeResult('missing_replicas', str(e), full_file_list)
+            raise
+        if not expanded:
+            # The scope of the DID is unknown, or it has no datasets
+            if negative_cache:
+                self.setNegativeResult('empty')
+            return
+        n_cached = len(full_file_list) - len(done) - n_resolved
+        if n_cached:
+            self.logger.info(f'Found {n_cached} of {len(expanded)} datasets in the cache.')
+
+        if self.cache:
+            with span('cache.write'):
+                self.setCachedResults(full_file_list)
+        if checkpoints:
+            checkpoints.clear(self.request_id, self.did)
+
+    def _expand(self, done, expanded):
+        "Datasets of the DID that are not in done, all of them are added to expanded"
+        for ds in self.rucio_adapter.expand_did(self.did):
+            expanded.append(ds)
+            if self.dataset_key(ds) not in done:
+                yield ds
+
+    def _lookup_datasets(self, datasets, use_dataset_cache, hits):
+        """
+        Look the datasets up in the dataset level of the cache, `DATASET_READ_BATCH`
+        at a time as they come. The files of the ones that are there go to hits.
+        :return: generator of the datasets that are not in the cache
+        """
+        while True:
+            batch = list(itertools.islice(datasets, DATASET_READ_BATCH))
+            if not batch:
+                return
+            if not (self.cache and use_dataset_cache):
+                yield from batch
+                continue
+            for ds, files in self.getCachedDatasets(batch):
+                if files is None:
+                    yield ds
+                else:
+                    hits.append(files)
+
+    @staticmethod
+    def _drain(hits, file_lists):
+        while hits:
+            files = hits.popleft()
+            file_lists.append(files)
+            yield files
+
+    def materialize(self, ds_files):
+        "Turn a chunk of files into the list of file dictionaries sent on, with the prefix"
+        if isinstance(ds_files, FileTable):
+            return ds_files.to_dicts(self.prefix)
+        if self.prefix:
+            # Cached lists are shared, so the files are copied
+            return [dict(af, paths=[self.prefix+fp for fp in af['paths']]) for af in ds_files]
+        return ds_files
 
     def lookup_files(self):
         """
-        lookup files, add cache prefix if needed.
+        lookup files, add cache prefix if needed. Yields a single list with
+        all the files, or in stream mode a list per resolved dataset.
         """
         n_files = 0
         ds_size = 0
@@ -92,32 +468,42 @@ class LookupRequest:
         avg_replicas = 0
         lookup_start = datetime.now()
 
-        if self.mcclient:
-            cachedResults = self.getCachedResults()
-
-        if cachedResults:
-            self.logger.info('Cache hit. Found {} files'.format(len(cachedResults)))
-            for af in cachedResults:
-                n_files += 1
-                ds_size += af['file_size']
-                total_paths += len(af['paths'])
-            yield cachedResults
-        else:
-            self.logger.info('Cache miss. Doing Rucio lookup.')
+        POPULARITY.record(self.did)
+        self.trace = start_trace('lookup', did=self.did, request_id=self.request_id)
+        profiler = LookupProfiler.for_lookup(self.trace)
+        LOOKUPS_IN_FLIGHT.inc()
+        try:
             full_file_list = []
-            for ds_files in self.rucio_adapter.list_files_for_did(self.did):
-                for af in ds_files:
-                    n_files += 1
-                    ds_size += af['file_size']
-                    total_paths += len(af['paths'])
-                    if self.prefix:
-                        af['paths'] = [self.prefix+fp for fp in af['paths']]
-                    full_file_list.append(af)
-            if self.mcclient:
-                self.setCachedResults(full_file_list)
-            yield full_file_list
+            # Steps of the lookup can run on different threads, each is
+            # attached to the trace while it works for the lookup
+            for ds_files in attached(self.trace, self.lookup_chunks()):
+                with attach(self.trace):
+                    # Totals come from the columns, before the files are materialized
+                    chunk_files, chunk_size, chunk_paths = file_totals(ds_files)
+                    n_files += chunk_files
+                    ds_size += chunk_size
+                    total_paths += chunk_paths
+                    ds_files = self.materialize(ds_files)
+                if not self.stream:
+                    full_file_list.extend(ds_files)
+                elif ds_files:
+                    yield ds_files
+            if not self.stream:
+                yield full_file_list
+        finally:
+            LOOKUPS_IN_FLIGHT.dec()
+            self.trace.attributes.update(source=self.source, n_files=n_files)
+            self.trace.end()
+            if profiler:
+                profiler.finish(f'{self.request_id}-{lookup_start:%Y%m%dT%H%M%S}',
+                                (datetime.now() - lookup_start).total_seconds())
 
         lookup_finish = datetime.now()
+        duration = (lookup_finish-lookup_start).total_seconds()
+        LOOKUP_SECONDS.labels(self.source).observe(duration)
+        LOOKUP_FILES.labels(self.source).inc(n_files)
+        if duration > 0:
+            LOOKUP_FILES_PER_SECOND.labels(self.source).observe(n_files / duration)
 
         if n_files:
             avg_replicas = float(total_paths)/n_files
@@ -127,9 +513,40 @@ class LookupRequest:
             'n_files': n_files,
             'size': ds_size,
             'avg_replicas': avg_replicas,
-            'lookup_duration': (lookup_finish-lookup_start).total_seconds()
+            'lookup_duration': duration,
+            'phases': {name: round(seconds, 3)
+                       for name, seconds in self.trace.phases().items()}
         }
         self.logger.info(
             "Lookup finished. " +
             f"Metric: {json.dumps(metric)}"
         )
+
+    async def lookup_files_async(self, executor=None):
+        """
+        Async version of `lookup_files`. Every step of the lookup, which makes
+        blocking rucio and cache calls, runs in an executor thread, so the event
+        loop can serve other lookups in the meantime.
+        :param executor: concurrent.futures executor to use, defaults to the
+                         default executor of the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        files = self.lookup_files()
+        done = object()
+        step = None
+        try:
+            while True:
+                # Shielded, so that a cancelled lookup still knows when the
+                # step running in the executor thread is over
+                step = loop.run_in_executor(executor, next, files, done)
+                chunk = await asyncio.shield(step)
+                if chunk is done:
+                    break
+                yield chunk
+        finally:
+            if step is not None and not step.done():
+                # The generator can only be closed once the thread left it
+                await asyncio.wait([step])
+                if not step.cancelled():
+                    step.exception()
+            await asyncio.shield(loop.run_in_executor(executor, files.close))
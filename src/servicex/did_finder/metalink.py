@@ -0,0 +1,100 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from xml.etree import ElementTree
+
+METALINK_NS = '{urn:ietf:params:xml:ns:metalink}'
+FILE_TAG = METALINK_NS + 'file'
+
+
+def _chunks(source, chunk_size):
+    if isinstance(source, (str, bytes)):
+        for start in range(0, len(source), chunk_size):
+            yield source[start:start + chunk_size]
+    else:
+        yield from source
+
+
+def _parse_file(elem):
+    record = {
+        'identity': None,
+        'adler32': None,
+        'size': None,
+        'paths': [],
+        'rses': [],
+        'parents': []
+    }
+    replicas = []
+    for child in elem:
+        tag = child.tag
+        if tag == METALINK_NS + 'url':
+            replicas.append((int(child.get('priority', '0'), 10), child.text,
+                             child.get('location')))
+        elif tag == METALINK_NS + 'hash':
+            if child.get('type') == 'adler32':
+                record['adler32'] = child.text
+        elif tag == METALINK_NS + 'size':
+            record['size'] = int(child.text, 10)
+        elif tag == METALINK_NS + 'identity':
+            record['identity'] = child.text
+        elif tag == METALINK_NS + 'parents':
+            record['parents'] = [p.text for p in child]
+    replicas.sort(key=lambda r: r[0])
+    record['paths'] = [url for _, url, _ in replicas]
+    record['rses'] = [rse for _, _, rse in replicas]
+    return record
+
+
+def parse_metalink(source, chunk_size=65536):
+    """
+    Incrementally parses a rucio metalink document, yielding one record per
+    file as soon as its element has been read. Elements are discarded once
+    they have been turned into records, so neither the whole document tree
+    nor a dict version of it is ever built.
+
+    :param source: metalink document as a string, or an iterable of string
+                   or bytes chunks (e.g. a streamed HTTP response).
+    :param chunk_size: size of the pieces a string document is fed in.
+    :return: generator of dictionaries with keys "identity", "adler32",
+             "size", "paths", "rses" and "parents", where paths are the replica
+             urls sorted by their priority, rses the RSE of each of them and
+             parents the datasets the file belongs to (only filled when rucio
+             was asked to resolve them).
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    root = None
+    for chunk in _chunks(source, chunk_size):
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if root is None:
+                    root = elem
+                continue
+            if elem.tag == FILE_TAG:
+                yield _parse_file(elem)
+                root.remove(elem)
+    parser.close()
@@ -0,0 +1,76 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+RUCIO_CALL_SECONDS = Histogram(
+    'did_finder_rucio_call_seconds', 'Duration of rucio calls', ['call'],
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+RUCIO_CALL_RETRIES = Counter(
+    'did_finder_rucio_call_retries', 'Rucio calls retried after a transient error', ['call']
+)
+RUCIO_CONCURRENCY_LIMIT = Gauge(
+    'did_finder_rucio_concurrency_limit', 'Allowed concurrent calls to a rucio endpoint',
+    ['call']
+)
+METALINK_PARSE_SECONDS = Histogram(
+    'did_finder_metalink_parse_seconds', 'Time spent parsing a metalink reply',
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+METALINK_BYTES = Counter(
+    'did_finder_metalink_bytes', 'Size of the metalink replies received from rucio'
+)
+CACHE_LOOKUPS = Counter(
+    'did_finder_cache_lookups', 'Lookups of DIDs in the cache', ['result']
+)
+CACHE_ERRORS = Counter(
+    'did_finder_cache_errors', 'Failed cache operations', ['operation']
+)
+CACHE_BYTES = Counter(
+    'did_finder_cache_bytes', 'Size of the serialized values read from and written to the cache',
+    ['operation']
+)
+LOOKUP_SECONDS = Histogram(
+    'did_finder_lookup_seconds', 'Duration of DID lookups', ['source'],
+    buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+)
+LOOKUP_FILES = Counter(
+    'did_finder_lookup_files', 'Files returned by DID lookups', ['source']
+)
+LOOKUP_FILES_PER_SECOND = Histogram(
+    'did_finder_lookup_files_per_second', 'Rate at which DID lookups return files', ['source'],
+    buckets=(10, 100, 500, 1000, 5000, 10000, 50000, 100000, 500000)
+)
+LOOKUPS_IN_FLIGHT = Gauge(
+    'did_finder_lookups_in_flight', 'DID lookups in progress'
+)
+
+
+def start_metrics_server(port: int):
+    '''Serve the metrics for prometheus on `port`'''
+    start_http_server(port)
@@ -0,0 +1,155 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+
+class PopularityTracker:
+    def __init__(self, history_file=None, half_life=86400):
+        """
+        Counts how often each DID is requested. Counts decay exponentially, so
+        DIDs that were popular long ago make way for the ones in use now.
+
+        :param history_file: file the counts are saved to and loaded from, so
+                             they survive restarts. Several processes can share
+                             it, each adds its counts to it when it saves.
+        :param half_life: seconds after which a request counts half.
+        """
+        self.history_file = history_file
+        self.half_life = half_life
+        self._scores = {}
+        # Counts recorded since the last save, not in the history file yet
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    def _decayed(self, entry, now):
+        score, updated = entry
+        return score * 0.5 ** ((now - updated) / self.half_life)
+
+    def _add(self, entry, other):
+        "Sum of two decayed counts"
+        if not entry:
+            return other
+        now = max(entry[1], other[1])
+        return self._decayed(entry, now) + self._decayed(other, now), now
+
+    def record(self, did):
+        now = time.time()
+        with self._lock:
+            self._scores[did] = self._add(self._scores.get(did), (1.0, now))
+            if self.history_file:
+                self._pending[did] = self._add(self._pending.get(did), (1.0, now))
+
+    def top(self, n):
+        "The n DIDs with the highest decayed counts, most popular first"
+        now = time.time()
+        with self._lock:
+            scores = [(self._decayed(entry, now), did) for did, entry in self._scores.items()]
+        scores.sort(reverse=True)
+        return [did for _, did in scores[:n]]
+
+    def _read(self):
+        if not os.path.exists(self.history_file):
+            return {}
+        try:
+            with open(self.history_file) as f:
+                return {did: tuple(entry) for did, entry in json.load(f).items()}
+        except (OSError, ValueError):
+            self.logger.warning(f"Could not read DID popularity from {self.history_file}.")
+            return {}
+
+    def load(self):
+        if not self.history_file:
+            return
+        scores = self._read()
+        with self._lock:
+            for did, entry in scores.items():
+                self._scores.setdefault(did, entry)
+        self.logger.info(f"Loaded popularity of {len(scores)} DIDs from {self.history_file}.")
+
+    def save(self, max_entries=10000):
+        """
+        Add the counts recorded since the last save to the history file, and
+        take up the counts of all the processes sharing it. The file is locked
+        meanwhile. Only the max_entries most popular DIDs are kept.
+        """
+        if not self.history_file:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        now = time.time()
+        tmp_file = f'{self.history_file}.{os.getpid()}.tmp'
+        try:
+            with open(f'{self.history_file}.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                scores = self._read()
+                for did, entry in pending.items():
+                    scores[did] = self._add(scores.get(did), entry)
+                scores = dict(sorted(scores.items(), key=lambda e: self._decayed(e[1], now),
+                                     reverse=True)[:max_entries])
+                with open(tmp_file, 'w') as f:
+                    json.dump(scores, f)
+                os.replace(tmp_file, self.history_file)
+        except OSError:
+            self.logger.warning(f"Could not save DID popularity to {self.history_file}.")
+            with self._lock:
+                for did, entry in pending.items():
+                    self._pending[did] = self._add(self._pending.get(did), entry)
+            return
+        with self._lock:
+            # Requests recorded during the save are added again for the next one
+            for did, entry in self._pending.items():
+                scores[did] = self._add(scores.get(did), entry)
+            self._scores = scores
+
+    def start(self, interval):
+        "Save every interval seconds, in the background"
+        if self._thread or not self.history_file:
+            return
+        self._thread = threading.Thread(target=self._loop, args=(interval,),
+                                        name='popularity', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self, interval):
+        while not self._stop.wait(interval):
+            self.save()
+
+
+# Requests seen by this process
+POPULARITY = PopularityTracker()
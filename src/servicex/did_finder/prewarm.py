@@ -0,0 +1,136 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import logging
+import threading
+
+from servicex.did_finder.lookup_request import FLIGHTS, LookupRequest
+from servicex.did_finder.popularity import POPULARITY
+from servicex.did_finder.rucio_calls import BudgetExceeded
+
+
+class Prewarmer:
+    def __init__(self, rucio_adapter, cache, watch_list=(), top_n=0, budget=1000,
+                 lead=600, interval=300, tracker=POPULARITY):
+        """
+        Keeps the cache warm for popular DIDs. Every interval seconds, the DIDs
+        of the watch list and the top_n most requested DIDs are resolved into
+        the cache if they are not cached or their entry expires within lead
+        seconds, until the budget of rucio calls of the round is used up.
+
+        :param rucio_adapter: adapter used for the lookups, its `RucioCaller`
+                              must not be shared, its `max_calls` enforces the
+                              budget.
+        :param cache: the cache to fill
+        :param watch_list: DIDs that are always kept warm, before the popular ones
+        :param top_n: number of the most requested DIDs kept warm
+        :param budget: rucio calls a round may make, including retries. The
+                       lookup of a DID that runs out of it is left unfinished.
+        :param lead: seconds before expiry at which an entry is resolved again
+        :param interval: seconds between rounds
+        :param tracker: `PopularityTracker` of the requested DIDs
+        """
+        self.rucio_adapter = rucio_adapter
+        self.cache = cache
+        self.watch_list = list(watch_list)
+        self.top_n = top_n
+        self.budget = budget
+        self.lead = lead
+        self.interval = interval
+        self.tracker = tracker
+        self._stop = threading.Event()
+        self._thread = None
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    def candidates(self):
+        "DIDs to keep warm, watch list first, without duplicates"
+        dids = self.watch_list + (self.tracker.top(self.top_n) if self.top_n else [])
+        return list(dict.fromkeys(dids))
+
+    def warm(self, did):
+        """
+        Resolve the DID into the cache if its entry is missing or about to expire.
+        :return: True if it was resolved
+        """
+        request = LookupRequest(did, self.rucio_adapter, request_id='prewarm',
+                                cache=self.cache)
+        age = request.cache_age()
+        if age is not None and age < request.ttl - self.lead:
+            return False
+        # A missing entry may still have cached datasets, an expiring one
+        # has datasets of the same age, so they are all resolved again, and
+        # it is kept rather than replaced if the lookup finds no files.
+        # Requests for the DID wait for the result in the cache rather than
+        # join, as the lookup can stop when the budget is used up.
+        chunks, _ = FLIGHTS.join(request.flight_key(),
+                                 lambda: request.resolve(use_dataset_cache=age is None,
+                                                         negative_cache=age is None),
+                                 shared=False)
+        for _ in chunks:
+            pass
+        return True
+
+    def run_once(self):
+        "Do a round of warming, return the number of DIDs that were resolved"
+        caller = self.rucio_adapter.caller
+        start_calls = caller.calls
+        caller.max_calls = start_calls + self.budget
+        n_warmed = 0
+        for did in self.candidates():
+            try:
+                n_warmed += self.warm(did)
+            except BudgetExceeded:
+                self.logger.info(f'Pre-warming stopped at {did}, the rucio call budget '
+                                 'is used up.')
+                break
+            except Exception:
+                self.logger.exception(f'Pre-warming {did} failed.')
+        self.tracker.save()
+        if n_warmed:
+            self.logger.info(f'Pre-warmed {n_warmed} DIDs with '
+                             f'{caller.calls - start_calls} rucio calls.')
+        return n_warmed
+
+    def start(self):
+        "Warm the cache now and then every interval seconds, in the background"
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._loop, name='prewarm', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                self.logger.exception('Pre-warming round failed.')
+            if self._stop.wait(self.interval):
+                return
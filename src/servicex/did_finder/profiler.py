@@ -0,0 +1,169 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import logging
+import os
+import sys
+import threading
+import time
+
+from servicex.did_finder.tracing import trace_of_thread
+
+
+def fold(frame, thread_name):
+    "The stack of frame as a folded stack, rooted at the name of its thread"
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+        frame = frame.f_back
+    stack.append(thread_name)
+    return ';'.join(reversed(stack))
+
+
+def write_folded(stacks, path):
+    "Write samples as folded stacks, one stack and its count per line"
+    with open(path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write(f'{stack} {count}\n')
+
+
+class LookupSampler:
+    def __init__(self, interval=0.01):
+        '''Samples the stacks of the threads working for the lookups being
+        profiled, see `tracing.attach`, every interval seconds from a background
+        thread, without tracing every call, so it can stay on for whole lookups.
+        A single sampler serves all the lookups of the process, it runs while
+        there are any, and keeps the samples of each lookup apart as folded
+        stacks, the input of flamegraph.pl and speedscope.'''
+        self.interval = interval
+        # Folded stacks of the lookups being profiled, by id of their root span
+        self._lookups = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, root):
+        "Start collecting the samples of the lookup of root span root"
+        with self._lock:
+            self._lookups[id(root)] = {}
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profiler',
+                                                daemon=True)
+                self._thread.start()
+
+    def remove(self, root):
+        ":return: the samples of the lookup as folded stacks and their counts"
+        with self._lock:
+            return self._lookups.pop(id(root), {})
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._lookups:
+                    self._thread = None
+                    return
+                lookups = dict(self._lookups)
+            names = None
+            for thread_id, frame in sys._current_frames().items():
+                root = trace_of_thread(thread_id)
+                stacks = lookups.get(id(root)) if root is not None else None
+                if stacks is None or thread_id == own_id:
+                    continue
+                # Only the stacks of the threads of profiled lookups are walked
+                if names is None:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                folded = fold(frame, names.get(thread_id, str(thread_id)))
+                with self._lock:
+                    stacks[folded] = stacks.get(folded, 0) + 1
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def get_sampler(interval=0.01):
+    "The sampler shared by the lookups of this process"
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = LookupSampler(interval)
+    return _sampler
+
+
+class LookupProfiler:
+    def __init__(self, trace, directory, threshold=60.0, interval=0.01):
+        """
+        Profiles a lookup and keeps the profile only if the lookup was slow.
+        Only the threads working for the lookup, the ones attached to its
+        trace, are in its profile. Created by `for_lookup` from the environment:
+
+        PROFILE_DIR: directory the profiles are written to. No profiling if not set.
+        PROFILE_THRESHOLD: seconds a lookup has to take for its profile to be kept.
+        PROFILE_INTERVAL: seconds between samples, of the sampler of the process.
+        """
+        self.trace = trace
+        self.directory = directory
+        self.threshold = threshold
+        self.sampler = get_sampler(interval)
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    @classmethod
+    def for_lookup(cls, trace):
+        ":param trace: root span of the lookup"
+        directory = os.getenv('PROFILE_DIR')
+        if not directory:
+            return None
+        return cls(trace, directory, float(os.getenv('PROFILE_THRESHOLD', '60')),
+                   float(os.getenv('PROFILE_INTERVAL', '0.01'))).start()
+
+    def start(self):
+        self.sampler.add(self.trace)
+        return self
+
+    def finish(self, name, duration):
+        """
+        Stop profiling, and write the profile if the lookup took longer than
+        the threshold.
+        :param name: name of the profile file, without extension
+        :param duration: seconds the lookup took
+        :return: path of the profile, or None if it was not written
+        """
+        stacks = self.sampler.remove(self.trace)
+        if duration < self.threshold:
+            return None
+        path = os.path.join(self.directory, f'{name}.folded')
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_folded(stacks, path)
+        except OSError:
+            self.logger.warning(f'Could not write the lookup profile {path}.')
+            return None
+        self.logger.info(f'Lookup took {duration:.1f} seconds, wrote its profile to {path}.')
+        return path
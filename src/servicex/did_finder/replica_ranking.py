@@ -0,0 +1,242 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+from collections import namedtuple
+
+# A replica of a file. priority is its position in rucio's (geoip) order.
+Replica = namedtuple('Replica', ['url', 'rse', 'priority', 'size'])
+
+
+class RankingPolicy:
+    '''Base of the replica ranking policies. A policy can drop replicas with
+    `accept` and order them with `key`, replicas with lower keys come first.'''
+
+    def refresh(self):
+        "Called before each batch of files is ranked"
+        pass
+
+    def accept(self, replica):
+        return True
+
+    def key(self, replica):
+        return 0
+
+
+class SitePreference(RankingPolicy):
+    def __init__(self, rses):
+        '''Static preference of RSEs, in the order given. Replicas on other
+        RSEs come after them.'''
+        self.order = {rse: i for i, rse in enumerate(rses)}
+
+    def key(self, replica):
+        return self.order.get(replica.rse, len(self.order))
+
+
+class ExcludeRSEs(RankingPolicy):
+    def __init__(self, rses=()):
+        '''Drops replicas on blacklisted or overloaded RSEs. The set of RSEs
+        can be replaced at any time with `update`.'''
+        self.rses = frozenset(rses)
+
+    def update(self, rses):
+        self.rses = frozenset(rses)
+
+    def accept(self, replica):
+        return replica.rse not in self.rses
+
+
+class RSEHistory(RankingPolicy):
+    def __init__(self, stats_file=None, alpha=0.2, reload_interval=60):
+        """
+        Orders replicas by the expected time to read them, from the measured
+        latency, throughput and failure rate of their RSE. Measurements are
+        fed back with `record`, or by another process through the stats file,
+        which is reloaded when it changes.
+
+        :param stats_file: JSON file with the statistics of each RSE.
+        :param alpha: weight of a new measurement in the moving averages.
+        :param reload_interval: minimum seconds between checks of the stats file.
+        """
+        self.stats_file = stats_file
+        self.alpha = alpha
+        self.reload_interval = reload_interval
+        self.stats = {}
+        self._default = None
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    def record(self, rse, seconds, n_bytes=0, ok=True):
+        """
+        Add a measurement of reading from an RSE.
+        :param rse: name of the RSE
+        :param seconds: time until the first byte for reads that move no
+                        data, otherwise the duration of the whole read
+        :param n_bytes: number of bytes read
+        :param ok: whether the read succeeded
+        """
+        with self._lock:
+            s = self.stats.get(rse)
+            if s is None:
+                s = self.stats[rse] = {'latency': seconds, 'throughput': None,
+                                       'failures': 0.0}
+            a = self.alpha
+            s['failures'] = (1 - a) * s['failures'] + a * (0.0 if ok else 1.0)
+            if ok and n_bytes and seconds > 0:
+                rate = n_bytes / seconds
+                s['throughput'] = rate if s['throughput'] is None \
+                    else (1 - a) * s['throughput'] + a * rate
+            elif ok:
+                s['latency'] = (1 - a) * s['latency'] + a * seconds
+            self._default = None
+
+    def expected_seconds(self, rse, size):
+        "Expected time to read size bytes from the RSE, longer for unreliable RSEs"
+        s = self.stats.get(rse) or self._get_default()
+        seconds = s['latency']
+        if size and s['throughput']:
+            seconds += size / s['throughput']
+        return seconds / max(1.0 - s['failures'], 0.05)
+
+    def key(self, replica):
+        return self.expected_seconds(replica.rse, replica.size)
+
+    def refresh(self):
+        now = time.monotonic()
+        if not self.stats_file or now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.stats_file)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.stats_file) as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            self.logger.warning(f"Could not read RSE statistics from {self.stats_file}.")
+            return
+        with self._lock:
+            self.stats = {rse: {'latency': float(s.get('latency', 0.0)),
+                                'throughput': s.get('throughput'),
+                                'failures': float(s.get('failures', 0.0))}
+                          for rse, s in stats.items()}
+            self._default = None
+        self.logger.info(f"Loaded statistics of {len(stats)} RSEs from {self.stats_file}.")
+
+    def save(self):
+        tmp_file = f'{self.stats_file}.{os.getpid()}.tmp'
+        with self._lock:
+            stats = {rse: dict(s) for rse, s in self.stats.items()}
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(stats, f)
+            os.replace(tmp_file, self.stats_file)
+        except OSError:
+            self.logger.warning(f"Could not save RSE statistics to {self.stats_file}.")
+
+    def _get_default(self):
+        # RSEs without measurements are expected to be typical, so they are
+        # neither starved nor preferred over measured ones
+        default = self._default
+        if default is None:
+            stats = list(self.stats.values())
+            throughputs = [s['throughput'] for s in stats if s['throughput']]
+            default = {
+                'latency': statistics.median(s['latency'] for s in stats) if stats else 0.0,
+                'throughput': statistics.median(throughputs) if throughputs else None,
+                'failures': 0.0
+            }
+            self._default = default
+        return default
+
+
+class ReplicaRanker:
+    def __init__(self, policies=(), max_replicas=0):
+        '''Orders the replicas of each file by the keys of the policies, in
+        the order of the policies, keeping rucio's order between replicas that
+        are otherwise equal. If the policies drop every replica of a file, all
+        of them are kept.
+
+        :param policies: list of `RankingPolicy`
+        :param max_replicas: maximum number of replicas kept per file, all if 0
+        '''
+        self.policies = list(policies)
+        self.max_replicas = max_replicas
+
+    def refresh(self):
+        for policy in self.policies:
+            policy.refresh()
+
+    def rank(self, record):
+        """
+        Rank the replicas of a file.
+        :param record: file as returned by `parse_metalink`
+        :return: list of the urls of the replicas, best first
+        """
+        paths = record['paths']
+        if self.policies:
+            replicas = [Replica(url, rse, i, record['size'])
+                        for i, (url, rse) in enumerate(zip(paths, record['rses']))]
+            accepted = [r for r in replicas
+                        if all(p.accept(r) for p in self.policies)] or replicas
+            accepted.sort(key=lambda r: tuple(p.key(r) for p in self.policies)
+                          + (r.priority,))
+            paths = [r.url for r in accepted]
+        if self.max_replicas:
+            paths = paths[:self.max_replicas]
+        return paths
+
+
+def create_ranker(prefer_rses=(), exclude_rses=(), stats_file=None, max_replicas=0):
+    """
+    Build the replica ranker from the command line settings.
+    :return: the `ReplicaRanker`, or None if replicas are kept in rucio's order
+    """
+    policies = []
+    if exclude_rses:
+        policies.append(ExcludeRSEs(exclude_rses))
+    if prefer_rses:
+        policies.append(SitePreference(prefer_rses))
+    if stats_file:
+        policies.append(RSEHistory(stats_file))
+    if not policies and not max_replicas:
+        return None
+    return ReplicaRanker(policies, max_replicas)
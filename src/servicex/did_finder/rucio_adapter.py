@@ -26,18 +26,34 @@
 # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import itertools
 import logging
-import xmltodict
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from rucio.common.exception import DataIdentifierNotFound
-from rucio.client.scopeclient import ScopeClient
+from servicex.did_finder.file_table import FileTable
+from servicex.did_finder.metalink import parse_metalink
+from servicex.did_finder.metrics import METALINK_BYTES, METALINK_PARSE_SECONDS
+from servicex.did_finder.rucio_calls import RucioCaller
+from servicex.did_finder.scope_index import ScopeIndex
+from servicex.did_finder.tracing import bind, span
 
 
 class RucioAdapter:
-    def __init__(self, did_client, replica_client, report_logical_files=False):
+    def __init__(self, did_client, replica_client, report_logical_files=False, threads=1,
+                 batch_size=1, scope_index=None, ranker=None, max_depth=10, caller=None):
         self.did_client = did_client
         self.replica_client = replica_client
         self.report_logical_files = report_logical_files
-        self.all_scopes = []
+        self.threads = max(1, threads)
+        self.batch_size = max(1, batch_size)
+        self.scope_index = scope_index if scope_index is not None else ScopeIndex()
+        # Orders (and filters) the replicas of each file, rucio's order if None
+        self.ranker = ranker
+        # Levels of nested containers below the DID that are expanded
+        self.max_depth = max_depth
+        # Retries and rate limits the calls to rucio
+        self.caller = caller if caller is not None else RucioCaller()
         # set logging to a null handler
         self.logger = logging.getLogger(__name__)
         self.logger.addHandler(logging.NullHandler())
@@ -54,109 +70,252 @@ class RucioAdapter:
             d['scope'], d['name'] = did.split(":")
             return d
 
-        if not self.all_scopes:
-            uns_scopes = ScopeClient().list_scopes()
-            self.all_scopes = sorted(uns_scopes, key=len, reverse=True)
-
-        for sc in self.all_scopes:
-            if did.startswith(sc):
-                d['scope'], d['name'] = sc, did
-                return d
+        sc = self.scope_index.find(did)
+        if sc:
+            d['scope'], d['name'] = sc, did
+            return d
 
         self.logger.error(f"Scope of the dataset {did} could not be determined.")
         return None
 
     def list_datasets_for_did(self, did):
-        parsed_did = self.parse_did(did)
-        if not parsed_did:
-            return []
+        """
+        List the datasets of the DID, see `expand_did`.
+        :return: list of [scope, name] of the datasets, None if the DID does not exist
+        """
         try:
-            datasets = []
-            did_info = self.did_client.get_did(parsed_did['scope'], parsed_did['name'])
-            if did_info['type'] == 'CONTAINER':
-                self.logger.info(f"{did} is a container of {did_info['length']} datasets.")
-                content = self.did_client.list_content(parsed_did['scope'], parsed_did['name'])
-                for c in content:
-                    datasets.append([c['scope'], c['name']])
-            elif did_info['type'] == 'DATASET':
-                datasets.append([parsed_did['scope'], parsed_did['name']])
-                self.logger.info(f"{did} is a dataset with {did_info['length']} files.")
-            else:
-                self.logger.info(f"{did} is a file: {did_info}.")
-                datasets.append([parsed_did['scope'], parsed_did['name']])
-            return datasets
+            return list(self.expand_did(did))
         except DataIdentifierNotFound:
             self.logger.warning(f"{did} not found")
             return None
 
-    @staticmethod
-    def get_paths(replicas):
-        """
-        extracts all the replica paths in a list sorted according
-        to their priorities.
-        """
-        if isinstance(replicas, dict):
-            replicas = [replicas]
-        paths = [None] * len(replicas)
-        for replica in replicas:
-            paths[int(replica['@priority'], 10)-1] = replica['#text']
-        return paths
-
-    @staticmethod
-    def get_adler(data):
-        if '#text' in data:
-            return data['#text']
-        for cks in data:
-            if 'adler32' in cks['@type']:
-                return cks['#text']
-        return None
-
-    def list_files_for_did(self, did):
+    def expand_did(self, did):
         """
-        from rucio, gets list of file replicas in metalink xml,
-        parses it, and returns a sorted list of all possible paths,
-        together with checksum and filesize.
+        Find the datasets of the DID, expanding nested containers up to
+        `max_depth` levels deep. Containers are listed concurrently with up to
+        `threads` requests, and each dataset is yielded once, as soon as it is
+        found, even if it is in more than one of the containers.
+        Raises DataIdentifierNotFound if the DID does not exist.
+        :return: generator of [scope, name] of the datasets
         """
-        datasets = self.list_datasets_for_did(did)
-        if not datasets:
+        parsed_did = self.parse_did(did)
+        if not parsed_did:
             return
-        no_replica_files = 0
-        for ds in datasets:
-            reps = self.replica_client.list_replicas(
-                [{'scope': ds[0], 'name': ds[1]}],
+        did_ref = [parsed_did['scope'], parsed_did['name']]
+        did_info = self.caller.call('get_did', self.did_client.get_did, *did_ref)
+        if did_info['type'] == 'CONTAINER':
+            self.logger.info(f"{did} is a container of {did_info['length']} datasets.")
+            yield from self._expand_container(did_ref)
+            return
+        if did_info['type'] == 'DATASET':
+            self.logger.info(f"{did} is a dataset with {did_info['length']} files.")
+        else:
+            self.logger.info(f"{did} is a file: {did_info}.")
+        yield did_ref
+
+    def _list_content(self, container):
+        return self.caller.call('list_content',
+                                lambda: list(self.did_client.list_content(*container)))
+
+    def _expand_container(self, container):
+        seen = {f'{container[0]}:{container[1]}'}
+        with ThreadPoolExecutor(max_workers=self.threads,
+                                thread_name_prefix='rucio-expand') as executor:
+            pending = {executor.submit(bind(self._list_content), container): 0}
+            try:
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        depth = pending.pop(future)
+                        for c in future.result():
+                            key = f"{c['scope']}:{c['name']}"
+                            if key in seen:
+                                continue
+                            seen.add(key)
+                            child = [c['scope'], c['name']]
+                            if c.get('type') != 'CONTAINER':
+                                yield child
+                            elif depth < self.max_depth:
+                                pending[executor.submit(bind(self._list_content), child)] = \
+                                    depth + 1
+                            else:
+                                self.logger.warning(f"Not expanding {key}, it is nested more "
+                                                    f"than {self.max_depth} levels deep.")
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def list_files_for_dataset(self, ds):
+        """
+        from rucio, gets list of file replicas of a single dataset in metalink xml
+        and parses it.
+        :param ds: [scope, name] of the dataset
+        :return: tuple of the `FileTable` of the files and the number of files
+                 without replicas
+        """
+        return self.list_files_for_datasets([ds])[0]
+
+    def list_files_for_datasets(self, datasets):
+        """
+        from rucio, gets list of file replicas of several datasets with a single
+        metalink request and splits the files back up by the dataset they belong to.
+        :param datasets: list of [scope, name] of the datasets
+        :return: list with a tuple of the `FileTable` of the files and the number of
+                 files without replicas for each of the datasets, in the same order.
+        """
+        with span('datasets', datasets=','.join(f'{ds[0]}:{ds[1]}' for ds in datasets)):
+            if self.report_logical_files:
+                return [self.list_logical_files(ds) for ds in datasets]
+            reps = self.caller.call(
+                'list_replicas',
+                self.replica_client.list_replicas,
+                [{'scope': ds[0], 'name': ds[1]} for ds in datasets],
                 schemes=['root'],
                 metalink=True,
-                sort='geoip'
+                sort='geoip',
+                resolve_parents=len(datasets) > 1
             )
-            d = xmltodict.parse(reps)
-
-            g_files = []
-            if 'file' in d['metalink']:
-                # if only one file, xml returns a dict and not a list.
-                if isinstance(d['metalink']['file'], dict):
-                    mfile = [d['metalink']['file']]
-                else:
-                    mfile = d['metalink']['file']
-                for f in mfile:
-                    # Path is either a list of replicas or a single logical name
-                    if 'url' not in f:
-                        self.logger.error(f"File {f['identity']} has no replicas.")
-                        no_replica_files += 1
-                        continue
-                    path = self.get_paths(f['url']) \
-                        if not self.report_logical_files else \
-                        [f['identity'].strip('cms:')]
-
-                    g_files.append(
-                        {
-                            'adler32': self.get_adler(f['hash']),
-                            'file_size': int(f['size'], 10),
-                            'file_events': 0,
-                            'paths': path
-                        }
-                    )
-            yield g_files
+            METALINK_BYTES.inc(len(reps))
+            with span('metalink.parse', bytes=len(reps)):
+                result = self._parse_replicas(datasets, reps)
+            if result is None:
+                # Files of a batch are never guessed into a dataset, they would
+                # be cached as part of it
+                self.logger.warning('Could not tell which dataset all the files of a batch '
+                                    'belong to, looking the datasets up one at a time.')
+                return [self.list_files_for_datasets([ds])[0] for ds in datasets]
+            return result
+
+    def _parse_replicas(self, datasets, reps):
+        """
+        :return: see `list_files_for_datasets`, None if the parents of a file
+                 name none of several datasets.
+        """
+        parse_start = time.perf_counter()
+        if self.ranker:
+            self.ranker.refresh()
+        ds_index = {f'{ds[0]}:{ds[1]}': i for i, ds in enumerate(datasets)}
+        g_files = [FileTable() for _ in datasets]
+        no_replica_files = [0] * len(datasets)
+        for f in parse_metalink(reps):
+            i = next((ds_index[p] for p in f['parents'] if p in ds_index), None)
+            if i is None:
+                if len(datasets) > 1:
+                    self.logger.warning(f"Could not tell which dataset {f['identity']} "
+                                        "belongs to.")
+                    return None
+                i = 0
+
+            # Path is either a list of replicas or a single logical name
+            if not f['paths']:
+                self.logger.error(f"File {f['identity']} has no replicas.")
+                no_replica_files[i] += 1
+                continue
+            if self.ranker:
+                path = self.ranker.rank(f)
+            else:
+                path = f['paths']
+
+            g_files[i].append(f['adler32'], f['size'], path)
+        METALINK_PARSE_SECONDS.observe(time.perf_counter() - parse_start)
+        return list(zip(g_files, no_replica_files))
+
+    def list_logical_files(self, ds):
+        """
+        from rucio, gets the list of files of a dataset with their size and
+        checksum, without looking up their replicas. Used when only logical
+        names are reported.
+        :param ds: [scope, name] of the dataset
+        :return: tuple of the `FileTable` of the files and 0, as replicas are
+                 not looked at
+        """
+        g_files = FileTable()
+        files = self.caller.call('list_files',
+                                 lambda: list(self.did_client.list_files(ds[0], ds[1])))
+        for f in files:
+            identity = f"{f['scope']}:{f['name']}"
+            g_files.append(f['adler32'], f['bytes'] or 0, [identity.strip('cms:')])
+        return g_files, 0
+
+    def resolve_datasets(self, datasets):
+        """
+        Resolves the files of all the datasets, yielding tuples of the dataset
+        and the result of `list_files_for_dataset` for it as soon as it is
+        available. Datasets are looked up `batch_size` at a time. With more than
+        one thread, up to `threads` batches are looked up concurrently and results
+        come back in completion order. datasets can be a generator, lookups start
+        as soon as it has produced a batch.
+        """
+        datasets = iter(datasets)
+        batch_iter = iter(lambda: list(itertools.islice(datasets, self.batch_size)), [])
+        if self.threads == 1:
+            for batch in batch_iter:
+                for ds, result in zip(batch, self.list_files_for_datasets(batch)):
+                    yield (ds,) + result
+            return
+
+        with ThreadPoolExecutor(max_workers=self.threads,
+                                thread_name_prefix='rucio-adapter') as executor:
+            # Keep a bounded number of lookups in flight so that results do
+            # not pile up faster than the caller consumes them.
+            pending = {}
+            for batch in batch_iter:
+                pending[executor.submit(bind(self.list_files_for_datasets), batch)] = batch
+                if len(pending) >= 2 * self.threads:
+                    break
+            try:
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        batch = pending.pop(future)
+                        next_batch = next(batch_iter, None)
+                        if next_batch is not None:
+                            pending[executor.submit(bind(self.list_files_for_datasets),
+                                                    next_batch)] = next_batch
+                        for ds, result in zip(batch, future.result()):
+                            yield (ds,) + result
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def list_files_by_dataset(self, datasets, did):
+        """
+        Resolves the files of datasets of the DID, yielding tuples of the
+        dataset, the `FileTable` of its files and the number of its files
+        without replicas as each dataset is resolved. Raises ValueError at the
+        end if some of the files have no replicas.
+        """
+        no_replica_files = 0
+        for ds, g_files, ds_no_replica_files in self.resolve_datasets(datasets):
+            no_replica_files += ds_no_replica_files
+            yield ds, g_files, ds_no_replica_files
 
         if no_replica_files > 0:
             raise ValueError(f'Dataset {did} is missing replicas for {no_replica_files} '
                              'of its files.')
+
+    def list_files_for_did(self, did):
+        """
+        from rucio, gets list of file replicas in metalink xml,
+        parses it, and returns a sorted list of all possible paths,
+        together with checksum and filesize. Files are yielded as a
+        `FileTable` per dataset.
+        """
+        # Replicas of the first datasets are looked up while the rest of the
+        # containers are still being expanded
+        expanded = []
+
+        def datasets():
+            for ds in self.expand_did(did):
+                expanded.append(ds)
+                yield ds
+
+        try:
+            for _, g_files, _ in self.list_files_by_dataset(datasets(), did):
+                yield g_files
+        except DataIdentifierNotFound:
+            # Only a missing DID is an empty result, not a dataset of it that
+            # went missing while its replicas were looked up
+            if expanded:
+                raise
+            self.logger.warning(f"{did} not found")
@@ -0,0 +1,199 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import logging
+import random
+import threading
+import time
+
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
+from rucio.common.exception import DatabaseException, ResourceTemporaryUnavailable, \
+    ServerConnectionException, ServiceUnavailable
+from servicex.did_finder.metrics import RUCIO_CALL_RETRIES, RUCIO_CALL_SECONDS, \
+    RUCIO_CONCURRENCY_LIMIT
+from servicex.did_finder.tracing import span
+
+# Errors after which a call is worth retrying. Anything else, e.g.
+# DataIdentifierNotFound, is an answer and is passed on right away.
+TRANSIENT_ERRORS = (
+    ServiceUnavailable, ResourceTemporaryUnavailable, ServerConnectionException,
+    DatabaseException, RequestsConnectionError, Timeout, ConnectionError, TimeoutError
+)
+
+
+class BudgetExceeded(Exception):
+    "Raised instead of making a rucio call once the caller has made `max_calls`"
+
+
+class AIMDLimiter:
+    def __init__(self, name, limit=8, min_limit=1, max_limit=64, latency_target=0):
+        """
+        Limits the number of concurrent calls to a rucio endpoint. The limit
+        grows by one for every limit calls that succeed, and is halved when a
+        call fails with a transient error or is slower than latency_target.
+
+        :param name: name of the endpoint, used as the metrics label
+        :param limit: initial limit
+        :param min_limit: the limit never goes below this
+        :param max_limit: the limit never goes above this
+        :param latency_target: seconds a call may take before it counts as
+                               a sign of overload. Not used if 0.
+        """
+        self.name = name
+        self.limit = float(min(max(limit, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        RUCIO_CONCURRENCY_LIMIT.labels(name).set(self.limit)
+
+    def acquire(self, timeout=None):
+        "Wait for a free slot, return False if there was none within timeout seconds"
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, seconds, ok=True):
+        """
+        Free the slot of a call and adjust the limit.
+        :param seconds: duration of the call
+        :param ok: False if the call failed with a transient error
+        """
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if not ok or (self.latency_target and seconds > self.latency_target):
+                # Calls started before the last decrease report the same
+                # overload, only the first of them halves the limit
+                if now - self._last_decrease > seconds:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            RUCIO_CONCURRENCY_LIMIT.labels(self.name).set(self.limit)
+            self._cond.notify_all()
+
+
+class RucioCaller:
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30.0, deadline=0,
+                 max_concurrency=64, latency_target=0):
+        """
+        Call layer shared by everything that talks to rucio. Calls failing with
+        a transient error are retried with jittered exponential backoff, and the
+        calls to each endpoint are limited by an `AIMDLimiter`.
+
+        :param retries: number of retries after the first attempt
+        :param backoff: seconds before the first retry, doubled for every retry
+        :param max_backoff: longest wait between retries
+        :param deadline: seconds a call may take including waiting and retries,
+                         no limit if 0. It is checked before and between
+                         attempts, an attempt is bounded by the timeout of
+                         the rucio client.
+        :param max_concurrency: highest limit of concurrent calls per endpoint
+        :param latency_target: see `AIMDLimiter`
+
+        Setting `max_calls` makes calls raise `BudgetExceeded` once `calls`
+        has reached it.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        # Number of calls made, including retries
+        self.calls = 0
+        # No more calls are made once calls reaches it, no limit if 0
+        self.max_calls = 0
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    def limiter(self, call):
+        with self._lock:
+            limiter = self._limiters.get(call)
+            if limiter is None:
+                limiter = self._limiters[call] = AIMDLimiter(
+                    call, limit=min(8, self.max_concurrency), max_limit=self.max_concurrency,
+                    latency_target=self.latency_target)
+            return limiter
+
+    def call(self, call, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) as a call to the rucio endpoint named call.
+        Calls returning generators should be wrapped so they are consumed
+        inside fn, otherwise their errors are not retried.
+        :return: the result of fn
+        """
+        with span(f'rucio.{call}') as call_span:
+            return self._call(call, call_span, fn, *args, **kwargs)
+
+    def _call(self, call, call_span, fn, *args, **kwargs):
+        limiter = self.limiter(call)
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            if call_span is not None:
+                call_span.attributes['attempts'] = attempt + 1
+            with self._lock:
+                if self.max_calls and self.calls >= self.max_calls:
+                    raise BudgetExceeded(f'Rucio {call} call not made, the budget of '
+                                         f'{self.max_calls} calls is used up.')
+                self.calls += 1
+            remaining = self.deadline - (time.monotonic() - start) if self.deadline else None
+            if not limiter.acquire(remaining):
+                raise TimeoutError(f'Rucio {call} call did not start within '
+                                   f'{self.deadline} seconds.')
+            call_start = time.monotonic()
+            try:
+                with RUCIO_CALL_SECONDS.labels(call).time():
+                    result = fn(*args, **kwargs)
+            except TRANSIENT_ERRORS as e:
+                limiter.release(time.monotonic() - call_start, False)
+                error = e
+            except Exception:
+                limiter.release(time.monotonic() - call_start)
+                raise
+            else:
+                limiter.release(time.monotonic() - call_start)
+                return result
+
+            # Full jitter, so that calls failing together do not retry together
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            elapsed = time.monotonic() - start
+            if attempt >= self.retries or (self.deadline and elapsed + delay > self.deadline):
+                raise error
+            attempt += 1
+            RUCIO_CALL_RETRIES.labels(call).inc()
+            self.logger.warning(f'Rucio {call} call failed with {error!r}, retry {attempt} '
+                                f'of {self.retries} in {delay:.1f} seconds.')
+            time.sleep(delay)
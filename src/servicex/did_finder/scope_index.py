@@ -0,0 +1,161 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+import logging
+import os
+import threading
+import time
+from rucio.client.scopeclient import ScopeClient
+from servicex.did_finder.rucio_calls import RucioCaller
+
+# Marks a trie node that completes a scope name
+_SCOPE = None
+
+
+class ScopeIndex:
+    def __init__(self, scope_client=None, cache_file=None, refresh_interval=0, delimiter='.',
+                 caller=None, follow=False, timeout=None):
+        """
+        Index of the rucio scopes, used to find the scope of DIDs given without one.
+        Scopes are kept in a trie of their delimiter separated parts, so finding the
+        scope of a DID does not depend on the number of scopes.
+
+        :param scope_client: rucio ScopeClient. Created on first use if not given.
+        :param cache_file: file the scope list is saved to and loaded from on startup.
+        :param refresh_interval: seconds between background reloads of the scope list
+                                 from rucio. No reloads are done if 0.
+        :param delimiter: separator between the parts of scope and DID names.
+        :param caller: `RucioCaller` the scope list is loaded through.
+        :param follow: reload the scope list from the cache file instead of rucio,
+                       for processes sharing the file with one that refreshes it.
+        :param timeout: seconds the ScopeClient created on first use waits for a
+                        response from rucio, the client default if None.
+        """
+        self.scope_client = scope_client
+        self.cache_file = cache_file
+        self.refresh_interval = refresh_interval
+        self.delimiter = delimiter
+        self.caller = caller if caller is not None else RucioCaller()
+        self.follow = follow
+        self.timeout = timeout
+        self._trie = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.logger = logging.getLogger(__name__)
+        self.logger.addHandler(logging.NullHandler())
+
+    def find(self, did):
+        """
+        Find the longest scope that the DID name starts with.
+        :param did: DID name without a scope
+        :return: the scope or None if no scope matches
+        """
+        node = self._get_trie()
+        parts = did.split(self.delimiter)
+        n_parts = 0
+        for i, part in enumerate(parts):
+            node = node.get(part)
+            if node is None:
+                break
+            if _SCOPE in node:
+                n_parts = i + 1
+        if not n_parts:
+            return None
+        return self.delimiter.join(parts[:n_parts])
+
+    def update(self, scopes):
+        "Replace the indexed scopes"
+        trie = {}
+        for sc in scopes:
+            node = trie
+            for part in sc.split(self.delimiter):
+                node = node.setdefault(part, {})
+            node[_SCOPE] = True
+        self._trie = trie
+
+    def refresh(self):
+        "Reload the scope list from rucio and save it to the cache file"
+        if self.scope_client is None:
+            self.scope_client = ScopeClient() if self.timeout is None \
+                else ScopeClient(timeout=self.timeout)
+        scopes = self.caller.call('list_scopes', lambda: list(self.scope_client.list_scopes()))
+        self.update(scopes)
+        self.logger.info(f"Loaded {len(scopes)} scopes from rucio.")
+        if self.cache_file:
+            self._save(scopes)
+
+    def start(self):
+        "Start reloading the scope list in the background every refresh_interval seconds"
+        if self.refresh_interval <= 0 or self._thread:
+            return
+        self._thread = threading.Thread(target=self._refresh_loop, name='scope-index',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _get_trie(self):
+        if self._trie is None:
+            with self._lock:
+                if self._trie is None:
+                    if not self._load():
+                        self.refresh()
+                    self.start()
+        return self._trie
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                if not self.follow or not self._load():
+                    self.refresh()
+            except Exception:
+                self.logger.exception("Failed to refresh the rucio scopes.")
+
+    def _load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return False
+        try:
+            with open(self.cache_file) as f:
+                scopes = json.load(f)['scopes']
+        except (OSError, ValueError, KeyError):
+            self.logger.warning(f"Could not read scopes from {self.cache_file}.")
+            return False
+        self.update(scopes)
+        self.logger.info(f"Loaded {len(scopes)} scopes from {self.cache_file}.")
+        return True
+
+    def _save(self, scopes):
+        tmp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump({'updated': time.time(), 'scopes': scopes}, f)
+            os.replace(tmp_file, self.cache_file)
+        except OSError:
+            self.logger.warning(f"Could not save scopes to {self.cache_file}.")
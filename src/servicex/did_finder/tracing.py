@@ -0,0 +1,170 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from opentelemetry import trace as otel_trace
+    _otel_tracer = otel_trace.get_tracer('servicex.did_finder')
+except ImportError:  # pragma: no cover - opentelemetry is optional
+    otel_trace = None
+    _otel_tracer = None
+
+# Span that new spans are children of, in this thread (or executor task)
+_current_span = contextvars.ContextVar('current_span', default=None)
+# Root span of the lookup each thread works for, by thread id. Unlike the
+# current span, it can be read from other threads, e.g. by the profiler.
+_thread_traces = {}
+
+
+class Span:
+    def __init__(self, name, parent=None, **attributes):
+        '''A timed phase of a lookup. Spans of a lookup form a tree below the
+        root span, which collects all of them so they can be summarized and
+        exported when the lookup ends.'''
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.root = parent.root if parent is not None else self
+        if parent is None:
+            self.spans = [self]
+            self._lock = threading.Lock()
+        else:
+            with self.root._lock:
+                self.root.spans.append(self)
+
+    @property
+    def seconds(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def end(self):
+        self.end_ns = time.time_ns()
+        if self.root is self:
+            export(self)
+
+    def phases(self):
+        "Total seconds spent in the spans of each name below this root span"
+        totals = {}
+        with self._lock:
+            spans = list(self.spans[1:])
+        for span in spans:
+            totals[span.name] = totals.get(span.name, 0.0) + span.seconds
+        return totals
+
+
+def start_trace(name, **attributes):
+    "Start the root span of a lookup. It has to be ended explicitly."
+    return Span(name, **attributes)
+
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    """
+    Time the enclosed code as a child of parent, by default of the current
+    span. Nothing is recorded if there is no parent, so code can be traced
+    unconditionally.
+    """
+    parent = parent if parent is not None else _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent, **attributes)
+    token = _current_span.set(child)
+    try:
+        with attach(child.root):
+            yield child
+    finally:
+        _current_span.reset(token)
+        child.end()
+
+
+@contextmanager
+def attach(root):
+    "Mark the current thread as working for the lookup of root meanwhile"
+    thread_id = threading.get_ident()
+    previous = _thread_traces.get(thread_id)
+    _thread_traces[thread_id] = root
+    try:
+        yield
+    finally:
+        if previous is None:
+            _thread_traces.pop(thread_id, None)
+        else:
+            _thread_traces[thread_id] = previous
+
+
+def attached(root, iterable):
+    "Iterate, with the thread that asks for each item attached to root meanwhile"
+    iterator = iter(iterable)
+    while True:
+        with attach(root):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def trace_of_thread(thread_id):
+    "Root span of the lookup the thread works for, None if it works for none"
+    return _thread_traces.get(thread_id)
+
+
+def bind(fn):
+    '''Bind fn to the current span, for functions run on other threads,
+    e.g. submitted to an executor. The result can only run once at a time,
+    so bind for every submission.'''
+    return functools.partial(contextvars.copy_context().run, _run_attached, fn)
+
+
+def _run_attached(fn, *args, **kwargs):
+    current = _current_span.get()
+    if current is None:
+        return fn(*args, **kwargs)
+    with attach(current.root):
+        return fn(*args, **kwargs)
+
+
+def export(root):
+    'Send the spans of a finished lookup to OpenTelemetry, if it is installed'
+    if _otel_tracer is None:
+        return
+    contexts = {}
+    with root._lock:
+        spans = sorted(root.spans, key=lambda s: s.start_ns)
+    for s in spans:
+        otel_span = _otel_tracer.start_span(
+            s.name, context=contexts.get(id(s.parent)), start_time=s.start_ns,
+            attributes={k: v for k, v in s.attributes.items() if v is not None})
+        otel_span.end(end_time=s.end_ns or root.end_ns)
+        contexts[id(s)] = otel_trace.set_span_in_context(otel_span)
@@ -0,0 +1,179 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import pytest
+from pymemcache.exceptions import MemcacheUnexpectedCloseError
+
+from servicex.did_finder import cache as cache_module
+from servicex.did_finder.cache import BinarySerde, JsonSerde, LRUCache, MemcacheCache, \
+    TieredCache, create_cache
+
+FILES = [
+    {
+        'adler32': f'0a1b2c{i:02x}',
+        'file_size': 10**10 + i,
+        'file_events': i,
+        'paths': [f'root://site{r}//data/f{i}' for r in range(i % 4)]
+    } for i in range(20)
+]
+
+
+class TestLRUCache:
+    def test_get_set(self):
+        cache = LRUCache()
+        assert cache.get('a') is None
+        cache.set('a', [1, 2])
+        cache.set_many({'b': {'x': 1}, 'c': [3]})
+        assert cache.get('a') == [1, 2]
+        assert cache.get_many(['a', 'b', 'd']) == {'a': [1, 2], 'b': {'x': 1}}
+        assert cache.size == 4
+        cache.delete('a')
+        assert cache.get('a') is None
+        assert cache.size == 2
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=5)
+        cache.set('a', [1, 2])
+        cache.set('b', [1, 2])
+        cache.get('a')
+        cache.set('c', [1, 2])
+        assert cache.get('b') is None
+        assert cache.get('a') == [1, 2]
+        assert cache.get('c') == [1, 2]
+        assert cache.size == 4
+
+    def test_too_large_not_cached(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', [1, 2, 3])
+        assert cache.get('a') is None
+        assert cache.size == 0
+
+    def test_ttl(self, mocker):
+        now = mocker.patch('servicex.did_finder.cache.time.monotonic', return_value=100)
+        cache = LRUCache()
+        cache.set('a', [1], ttl=10)
+        cache.set('b', [1])
+        now.return_value = 111
+        assert cache.get('a') is None
+        assert cache.get('b') == [1]
+
+
+class TestMemcacheCache:
+    def test_errors_are_misses(self, mocker):
+        client = mocker.MagicMock()
+        client.get_many.side_effect = MemcacheUnexpectedCloseError()
+        client.set_many.side_effect = ConnectionRefusedError()
+        cache = MemcacheCache(client)
+        assert cache.get('a') is None
+        cache.set('a', [1], 10)
+        client.set_many.assert_called_with({'a': [1]}, 10, noreply=True)
+
+    def test_json_serde(self):
+        serde = JsonSerde()
+        value = [{'paths': ['root://a//f'], 'file_size': 1}]
+        data, flags = serde.serialize('k', value)
+        assert serde.deserialize('k', data, flags) == value
+
+
+class TestBinarySerde:
+    def test_files_round_trip(self):
+        serde = BinarySerde()
+        data, flags = serde.serialize('k', FILES)
+        assert isinstance(data, bytes)
+        assert flags == BinarySerde.FLAG_FILES
+        assert serde.deserialize('k', data, flags) == FILES
+
+    def test_smaller_than_json(self):
+        assert len(BinarySerde().serialize('k', FILES)[0]) < \
+            len(JsonSerde().serialize('k', FILES)[0])
+
+    @pytest.mark.parametrize('value', [
+        {'version': 2, 'token': 'abc', 'chunks': 3},
+        [],
+        [1, 2],
+        [dict(FILES[0], adler32=None)],
+        [dict(FILES[0], extra=1)],
+        [dict(FILES[0], paths=['a\nb'])],
+    ])
+    def test_other_values_as_json(self, value):
+        serde = BinarySerde()
+        data, flags = serde.serialize('k', value)
+        assert flags == BinarySerde.FLAG_JSON
+        assert serde.deserialize('k', data, flags) == value
+
+    def test_reads_json_serde(self):
+        data, flags = JsonSerde().serialize('k', FILES)
+        assert BinarySerde().deserialize('k', data.encode('ascii'), flags) == FILES
+
+
+class TestTieredCache:
+    def test_near_first(self, mocker):
+        far = mocker.MagicMock()
+        cache = TieredCache(LRUCache(), far)
+        cache.set('a', [1], 60)
+        far.set_many.assert_called_with({'a': [1]}, 60)
+        assert cache.get('a') == [1]
+        far.get_many.assert_not_called()
+
+    def test_far_copied_to_near(self):
+        near, far = LRUCache(), LRUCache()
+        far.set('a', [1])
+        cache = TieredCache(near, far)
+        assert cache.get('a') == [1]
+        assert near.get('a') == [1]
+        assert cache.get('b') is None
+
+
+class TestCreateCache:
+    @pytest.fixture(autouse=True)
+    def clean_env(self, monkeypatch):
+        monkeypatch.delenv('CACHE_BACKEND', raising=False)
+        monkeypatch.delenv('MEMCACHE', raising=False)
+
+    def test_no_cache(self):
+        assert create_cache() is None
+
+    def test_memcache_env(self, monkeypatch):
+        monkeypatch.setenv('MEMCACHE', 'True')
+        assert isinstance(create_cache(), MemcacheCache)
+
+    @pytest.mark.parametrize('backend, cls', [
+        ('lru', LRUCache), ('memcache', MemcacheCache), ('tiered', TieredCache)
+    ])
+    def test_backends(self, monkeypatch, backend, cls):
+        monkeypatch.setenv('CACHE_BACKEND', backend)
+        assert isinstance(create_cache(), cls)
+
+    def test_unknown_backend(self, monkeypatch):
+        monkeypatch.setenv('CACHE_BACKEND', 'redis')
+        with pytest.raises(ValueError):
+            create_cache()
+
+    def test_get_cache_shared(self, monkeypatch):
+        monkeypatch.setenv('CACHE_BACKEND', 'lru')
+        monkeypatch.setattr(cache_module, '_cache', None)
+        assert cache_module.get_cache() is cache_module.get_cache()
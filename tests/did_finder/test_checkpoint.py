@@ -0,0 +1,90 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import sqlite3
+
+from servicex.did_finder import checkpoint
+from servicex.did_finder.checkpoint import CheckpointStore, get_checkpoints
+from servicex.did_finder.file_table import FileTable
+
+
+def files(name, n=2):
+    return [{'adler32': '62b7c4b9', 'file_size': 1234, 'file_events': 0,
+             'paths': [f'root://a//{name}/f{i}', f'root://b//{name}/f{i}']} for i in range(n)]
+
+
+class TestCheckpointStore:
+    def test_save_load_clear(self, tmp_path):
+        store = CheckpointStore(str(tmp_path / 'checkpoints.db'))
+        table = FileTable()
+        table.append('62b7c4b9', 1234, ['root://a//ds1/f0', 'root://b//ds1/f0'])
+        store.save('req-1', 'scope:cont', 'dataset:scope:ds0', files('ds0'))
+        store.save('req-1', 'scope:cont', 'dataset:scope:ds1', table)
+        store.save('req-2', 'scope:cont', 'dataset:scope:ds0', files('ds0', 1))
+
+        # A new store on the same file, like after a restart
+        store = CheckpointStore(str(tmp_path / 'checkpoints.db'))
+        assert store.load('req-1', 'scope:cont') == {
+            'dataset:scope:ds0': files('ds0'),
+            'dataset:scope:ds1': table.to_dicts()
+        }
+        store.clear('req-1', 'scope:cont')
+        assert store.load('req-1', 'scope:cont') == {}
+        assert len(store.load('req-2', 'scope:cont')['dataset:scope:ds0']) == 1
+
+    def test_prune(self, mocker):
+        store = CheckpointStore(':memory:', max_age=60)
+        store.save('req-1', 'scope:cont', 'dataset:scope:ds0', files('ds0'))
+        mocker.patch('servicex.did_finder.checkpoint.time.time', return_value=1e12)
+        store.prune()
+        assert store.load('req-1', 'scope:cont') == {}
+
+    def test_database_errors_are_logged(self, tmp_path, caplog):
+        path = str(tmp_path / 'checkpoints.db')
+        store = CheckpointStore(path, timeout=0.1)
+        # Another worker writing to the database for longer than the timeout
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute('BEGIN EXCLUSIVE')
+        store.save('req-1', 'scope:cont', 'dataset:scope:ds0', files('ds0'))
+        assert 'Saving a checkpoint failed' in caplog.text
+        other.execute('ROLLBACK')
+
+        other.execute('DROP TABLE checkpoints')
+        assert store.load('req-1', 'scope:cont') == {}
+        store.clear('req-1', 'scope:cont')
+        store.prune()
+        assert 'Reading checkpoints failed' in caplog.text
+
+    def test_unopenable_database(self, tmp_path, monkeypatch, mocker, caplog):
+        monkeypatch.setattr(checkpoint, '_checkpoints', None)
+        monkeypatch.setenv('CHECKPOINT_DB', str(tmp_path / 'nonexistent' / 'ck.db'))
+        connect = mocker.spy(sqlite3, 'connect')
+        assert get_checkpoints() is None
+        assert 'lookups run without checkpoints' in caplog.text
+        # The failure is remembered, it is not retried for every lookup
+        assert get_checkpoints() is None
+        assert connect.call_count == 1
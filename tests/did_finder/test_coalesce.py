@@ -0,0 +1,178 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+import time
+
+import pytest
+
+from servicex.did_finder.coalesce import SingleFlight
+
+
+class TestSingleFlight:
+    def test_followers_share_chunks(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def produce():
+            calls.append(1)
+            yield 'a'
+            assert release.wait(5)
+            yield 'b'
+
+        leader, started = flights.join('k', produce)
+        assert started
+        follower, started = flights.join('k', produce)
+        assert not started
+        assert next(leader) == 'a'
+        assert flights.in_flight('k')
+        release.set()
+        assert list(leader) == ['b']
+        assert list(follower) == ['a', 'b']
+        assert len(calls) == 1
+        assert not flights.in_flight('k')
+
+    def test_new_flight_after_done(self):
+        flights = SingleFlight()
+        assert list(flights.join('k', lambda: iter([1]))[0]) == [1]
+        chunks, started = flights.join('k', lambda: iter([2]))
+        assert started
+        assert list(chunks) == [2]
+
+    def test_error(self):
+        flights = SingleFlight()
+
+        def produce():
+            yield 1
+            raise ValueError('boom')
+
+        chunks, _ = flights.join('k', produce)
+        assert next(chunks) == 1
+        with pytest.raises(ValueError, match='boom'):
+            next(chunks)
+
+    def test_chunks_dropped_once_read(self):
+        flights = SingleFlight()
+        release = threading.Event()
+
+        def produce():
+            yield 'a'
+            yield 'b'
+            assert release.wait(5)
+            yield 'c'
+
+        leader, _ = flights.join('k', produce)
+        follower, _ = flights.join('k', produce)
+        flight = flights._flights['k']
+        assert next(leader) == 'a'
+        assert next(leader) == 'b'
+        assert flight.chunks[0] == 'a'
+        assert next(follower) == 'a'
+        assert flight.chunks == ['b']
+        follower.close()
+        assert flight.chunks == []
+
+        # Too late to get all the chunks, so another lookup is started
+        late, started = flights.join('k', lambda: iter(['x']))
+        assert started
+        assert list(late) == ['x']
+        release.set()
+        assert list(leader) == ['c']
+        flight.wait()
+        assert not flights.in_flight('k')
+
+    def test_slow_reader_stops_producer(self):
+        flights = SingleFlight(max_pending=2)
+        produced = []
+
+        def produce():
+            for i in range(10):
+                produced.append(i)
+                yield i
+
+        chunks, _ = flights.join('k', produce)
+        flight = flights._flights['k']
+        with flight._cond:
+            assert flight._cond.wait_for(lambda: len(flight.chunks) == 2, 5)
+        # The producer waits to publish the third chunk
+        assert len(produced) == 3
+        assert list(chunks) == list(range(10))
+
+    def test_unread_flight_runs_to_the_end(self):
+        flights = SingleFlight(max_pending=1)
+        chunks, _ = flights.join('k', lambda: iter(range(10)))
+        flight = flights._flights['k']
+        chunks.close()
+        flight.wait()
+        assert flight.chunks == []
+
+    def test_not_shared(self, mocker):
+        flights = SingleFlight()
+        flights.logger = mocker.Mock()
+        release = threading.Event()
+
+        def produce():
+            assert release.wait(5)
+            yield 'a'
+
+        chunks, _ = flights.join('k', produce, shared=False)
+        # Callers with a fallback wait for the lookup and use it
+        fallback = []
+        waiter = threading.Thread(target=lambda: fallback.extend(
+            flights.join('k', lambda: iter(['x']), lambda: iter(['cached']))[0]))
+        waiter.start()
+        deadline = time.time() + 5
+        while not flights.logger.info.called:
+            assert time.time() < deadline
+            time.sleep(0.01)
+        release.set()
+        assert list(chunks) == ['a']
+        waiter.join(5)
+        assert fallback == ['cached']
+
+    def test_start_in_background(self):
+        flights = SingleFlight(max_pending=1)
+        release = threading.Event()
+        produced = []
+
+        def produce():
+            for i in range(3):
+                produced.append(i)
+                yield i
+                assert release.wait(5)
+
+        assert flights.start('k', produce)
+        flight = flights._flights['k']
+        # Only one background lookup runs, even once its chunks were dropped
+        with flight._cond:
+            assert flight._cond.wait_for(lambda: flight.base, 5)
+        assert not flights.start('k', produce)
+        release.set()
+        flight.wait()
+        assert produced == [0, 1, 2]
+        assert not flights.in_flight('k')
@@ -0,0 +1,84 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import pytest
+
+from servicex.did_finder.file_table import FileTable, PrefixTable, file_totals, split_url
+
+
+class TestFileTable:
+    @pytest.mark.parametrize('url, prefix', [
+        ('root://eosatlas.cern.ch:1094//eos/atlas/atlasdatadisk/rucio/data18/ab/cd/f.root',
+         'root://eosatlas.cern.ch:1094//eos/atlas/atlasdatadisk/rucio/'),
+        ('root://site.org:1094//pnfs/site.org/f.root', 'root://site.org:1094//'),
+        ('root://site.org', ''),
+        ('/store/data/f.root', ''),
+    ])
+    def test_split_url(self, url, prefix):
+        assert split_url(url)[0] == prefix
+        assert ''.join(split_url(url)) == url
+
+    def test_prefix_table(self):
+        table = PrefixTable()
+        assert table.intern('a') == 0
+        assert table.intern('b') == 1
+        assert table.intern('a') == 0
+        assert table.prefixes == ['a', 'b']
+
+    def test_round_trip(self):
+        files = [
+            {
+                'adler32': '0a1b2c3d',
+                'file_size': 10**10,
+                'file_events': 0,
+                'paths': ['root://a.org//atlas/rucio/data18/f1', 'root://b.org//rucio/data18/f1']
+            },
+            {'adler32': None, 'file_size': 1, 'file_events': 0, 'paths': []},
+            {'adler32': 'ABC', 'file_size': 2, 'file_events': 0, 'paths': ['/store/f2']},
+        ]
+        table = FileTable()
+        for f in files:
+            table.append(f['adler32'], f['file_size'], f['paths'])
+        assert len(table) == 3
+        assert list(table) == files
+        assert table.to_dicts('px:')[0]['paths'] == \
+            ['px:root://a.org//atlas/rucio/data18/f1', 'px:root://b.org//rucio/data18/f1']
+
+    def test_replica_paths_shared(self):
+        table = FileTable()
+        table.append('0a1b2c3d', 1,
+                     ['root://a.org//rucio/data18/f1', 'root://b.org//rucio/data18/f1'])
+        assert table.suffixes[0] is table.suffixes[1]
+
+    def test_file_totals(self):
+        table = FileTable()
+        table.append('0a1b2c3d', 10, ['root://a.org//rucio/f1', 'root://b.org//rucio/f1'])
+        table.append('0a1b2c3e', 20, [])
+        table.append('0a1b2c3f', 30, ['root://a.org//rucio/f3'])
+        assert file_totals(table) == (3, 60, 3)
+        assert file_totals(table.to_dicts()) == (3, 60, 3)
+        assert file_totals([]) == (0, 0, 0)
@@ -25,12 +25,60 @@
 # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import threading
+import time
+
 import pytest
+from prometheus_client import REGISTRY
+from rucio.common.exception import DataIdentifierNotFound
 
-from servicex.did_finder.lookup_request import LookupRequest
+from servicex.did_finder.cache import LRUCache, TieredCache
+from servicex.did_finder.checkpoint import CheckpointStore
+from servicex.did_finder.file_table import FileTable
+from servicex.did_finder.lookup_request import DATASET_READ_BATCH, FLIGHTS, LookupRequest
 from servicex.did_finder.rucio_adapter import RucioAdapter
 
 
+def dataset_chunks(n_datasets, n_files=2):
+    return [
+        [
+            {
+                'adler32': '0a1b2c3d',
+                'file_size': 100,
+                'file_events': 0,
+                'paths': [f'root://a//ds{d}/f{f}', f'root://b//ds{d}/f{f}']
+            } for f in range(n_files)
+        ] for d in range(n_datasets)
+    ]
+
+
+def rucio_serves(mock_rucio, chunks):
+    'Make the mock adapter serve each of the chunks as a dataset of the DID'
+    datasets = [['scope', f'ds{i}'] for i in range(len(chunks))]
+
+    def list_files_by_dataset(dss, did):
+        # The datasets that were resolved, they come from a generator
+        mock_rucio.resolved = []
+        for ds in dss:
+            mock_rucio.resolved.append(ds)
+            yield ds, chunks[datasets.index(ds)], 0
+
+    mock_rucio.expand_did.side_effect = lambda did: iter(datasets)
+    mock_rucio.list_files_by_dataset.side_effect = list_files_by_dataset
+    mock_rucio.list_files_for_did.side_effect = lambda did: iter(chunks)
+    return mock_rucio
+
+
+def wait_for_readers(key, n):
+    'Wait until n lookups joined the rucio lookup of key'
+    deadline = time.time() + 5
+    while len(getattr(FLIGHTS._flights.get(key), '_positions', ())) < n:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
 class TestLookupRequest:
     def test_init(self, mocker):
         mock_rucio = mocker.MagicMock(RucioAdapter)
@@ -65,12 +113,573 @@ class TestLookupRequest:
 
             mock_rucio.list_files_for_did.assert_called_with("my-did")
 
-    @pytest.mark.asyncio
-    async def test_lookup_files_empty_did(self, mocker):
+    def test_lookup_files_empty_did(self, mocker):
         'Make sure that a DID with zero files correctly returns zero files'
         mock_rucio = mocker.MagicMock(RucioAdapter)
         mock_rucio.list_files_for_did.return_value = []
 
         request = LookupRequest("my-did", mock_rucio)
 
-        assert len(await request.lookup_files()) == 0
+        assert list(request.lookup_files()) == [[]]
+
+    def test_lookup_files_prefix(self, mocker):
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        mock_rucio.list_files_for_did.return_value = iter(dataset_chunks(3))
+
+        request = LookupRequest("my-did", mock_rucio, prefix='root://xcache//')
+        result = list(request.lookup_files())
+
+        assert len(result) == 1
+        assert len(result[0]) == 6
+        assert all(p.startswith('root://xcache//root://') for f in result[0] for p in f['paths'])
+
+    def test_lookup_files_stream(self, mocker):
+        'Each dataset is yielded as soon as the adapter hands it over'
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        first_sent = threading.Event()
+
+        def list_files_for_did(did):
+            chunks = dataset_chunks(3)
+            yield chunks[0]
+            assert first_sent.wait(5)
+            yield from chunks[1:]
+            yield []
+
+        mock_rucio.list_files_for_did.side_effect = list_files_for_did
+
+        request = LookupRequest("my-did", mock_rucio, prefix='px:', stream=True)
+        chunks = request.lookup_files()
+        first = next(chunks)
+        first_sent.set()
+        assert len(first) == 2
+        assert first[0]['paths'] == ['px:root://a//ds0/f0', 'px:root://b//ds0/f0']
+        assert len(list(chunks)) == 2
+
+    def test_lookup_files_stream_fills_cache(self, mocker):
+        cache = LRUCache()
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        rucio_serves(mock_rucio, dataset_chunks(3))
+
+        request = LookupRequest("my-did", mock_rucio, stream=True, cache=cache)
+        assert len(list(request.lookup_files())) == 3
+        assert cache.get('my-did')['n_files'] == 6
+
+    def test_lookup_files_cache_hit(self, mocker):
+        cache = LRUCache()
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        rucio_serves(mock_rucio, dataset_chunks(3))
+        assert len(list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())[0]) == 6
+
+        mock_rucio.reset_mock()
+        result = list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+        assert len(result[0]) == 6
+        mock_rucio.expand_did.assert_not_called()
+        mock_rucio.list_files_by_dataset.assert_not_called()
+
+    def test_cache_chunked(self, mocker, monkeypatch):
+        monkeypatch.setenv('CACHE_CHUNK_SIZE', '4')
+        cache = LRUCache()
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        rucio_serves(mock_rucio, dataset_chunks(50))
+        request = LookupRequest("my-did", mock_rucio, cache=cache)
+        expected = list(request.lookup_files())[0]
+
+        manifest = cache.get('my-did')
+        assert manifest['chunks'] == 25
+        assert all(len(cache.get(f"{manifest['token']}:{i}")) == 4 for i in range(25))
+
+        spy = mocker.spy(cache, 'get_many')
+        request = LookupRequest("my-did", mock_rucio, cache=cache, prefix='px:', stream=True)
+        chunks = list(request.lookup_files())
+        assert spy.call_count == 3
+        assert len(chunks) == 25
+        assert [f['paths'] for c in chunks for f in c] == \
+            [['px:' + p for p in f['paths']] for f in expected]
+        assert mock_rucio.list_files_by_dataset.call_count == 1
+
+    def test_cache_stores_without_prefix(self, mocker):
+        cache = LRUCache()
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        rucio_serves(mock_rucio, dataset_chunks(1))
+        list(LookupRequest("my-did", mock_rucio, cache=cache, prefix='px:').lookup_files())
+
+        result = list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+        assert result[0][0]['paths'] == ['root://a//ds0/f0', 'root://b//ds0/f0']
+
+    def test_cache_incomplete_is_miss(self, mocker):
+        cache = LRUCache()
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        rucio_serves(mock_rucio, dataset_chunks(2))
+        list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+        cache.delete(cache.get('my-did')['token'] + ':0')
+
+        result = list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+        assert len(result[0]) == 4
+        assert mock_rucio.expand_did.call_count == 2
+
+    def test_cache_incomplete_after_first_chunks(self, mocker, monkeypatch):
+        monkeypatch.setenv('CACHE_CHUNK_SIZE', '1')
+        cache = LRUCache()
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        rucio_serves(mock_rucio, dataset_chunks(20))
+        list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+        cache.delete(cache.get('my-did')['token'] + ':30')
+
+        with pytest.raises(ValueError, match='incomplete'):
+            list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+        assert cache.get('my-did') is None
+
+    def test_lookup_files_file_tables(self, mocker):
+        'The adapter hands over compact tables, they are turned into dicts with the prefix'
+        cache = LRUCache()
+        tables = []
+        for chunk in dataset_chunks(2):
+            table = FileTable()
+            for f in chunk:
+                table.append(f['adler32'], f['file_size'], f['paths'])
+            tables.append(table)
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        rucio_serves(mock_rucio, tables)
+
+        request = LookupRequest("my-did", mock_rucio, cache=cache, prefix='px:')
+        result = list(request.lookup_files())
+        expected = [f for c in dataset_chunks(2) for f in c]
+        assert result == [[dict(f, paths=['px:' + p for p in f['paths']]) for f in expected]]
+
+        cached = list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+        assert cached == [expected]
+
+    def test_lookup_files_async(self, mocker):
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        mock_rucio.list_files_for_did.return_value = iter(dataset_chunks(3))
+
+        async def lookup():
+            request = LookupRequest("my-did", mock_rucio, stream=True)
+            return [c async for c in request.lookup_files_async()]
+
+        assert len(asyncio.run(lookup())) == 3
+
+    def test_lookup_files_async_overlap(self, mocker):
+        'Two lookups blocked in rucio do not block the event loop or each other'
+        barrier = threading.Barrier(2, timeout=5)
+
+        def list_files_for_did(did):
+            barrier.wait()
+            yield dataset_chunks(1)[0]
+
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        mock_rucio.list_files_for_did.side_effect = list_files_for_did
+
+        async def lookup(did):
+            return [c async for c in LookupRequest(did, mock_rucio).lookup_files_async()]
+
+        async def both():
+            return await asyncio.gather(lookup('did1'), lookup('did2'))
+
+        assert [len(r[0]) for r in asyncio.run(both())] == [2, 2]
+
+    def test_lookup_files_async_cancelled(self, mocker):
+        'A lookup cancelled during a step is closed once the step is over'
+        started = threading.Event()
+        release = threading.Event()
+
+        def list_files_for_did(did):
+            started.set()
+            release.wait(5)
+            yield dataset_chunks(1)[0]
+            yield dataset_chunks(1)[0]
+
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        mock_rucio.list_files_for_did.side_effect = list_files_for_did
+        in_flight = REGISTRY.get_sample_value('did_finder_lookups_in_flight')
+
+        async def lookup():
+            request = LookupRequest("my-did", mock_rucio, stream=True)
+            return [c async for c in request.lookup_files_async()]
+
+        async def cancel():
+            task = asyncio.ensure_future(lookup())
+            await asyncio.get_event_loop().run_in_executor(None, started.wait, 5)
+            task.cancel()
+            threading.Timer(0.1, release.set).start()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel())
+        assert release.is_set()
+        assert REGISTRY.get_sample_value('did_finder_lookups_in_flight') == in_flight
+
+    def test_lookup_metrics(self, mocker):
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        hits = sample('did_finder_cache_lookups_total', result='hit')
+        misses = sample('did_finder_cache_lookups_total', result='miss')
+        rucio_files = sample('did_finder_lookup_files_total', source='rucio')
+        cache_files = sample('did_finder_lookup_files_total', source='cache')
+
+        cache = LRUCache()
+        mock_rucio = rucio_serves(mocker.MagicMock(RucioAdapter), dataset_chunks(3))
+        files = LookupRequest("my-did", mock_rucio, cache=cache, stream=True).lookup_files()
+        next(files)
+        assert sample('did_finder_lookups_in_flight') == 1
+        list(files)
+        list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+
+        assert sample('did_finder_lookups_in_flight') == 0
+        assert sample('did_finder_cache_lookups_total', result='hit') == hits + 1
+        assert sample('did_finder_cache_lookups_total', result='miss') == misses + 1
+        assert sample('did_finder_lookup_files_total', source='rucio') == rucio_files + 6
+        assert sample('did_finder_lookup_files_total', source='cache') == cache_files + 6
+
+    def test_lookups_coalesced(self, mocker):
+        'Concurrent lookups of the same DID share a single rucio lookup'
+        release = threading.Event()
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+
+        def list_files_for_did(did):
+            assert release.wait(5)
+            yield from dataset_chunks(3)
+
+        mock_rucio.list_files_for_did.side_effect = list_files_for_did
+        results = {}
+
+        def lookup(i):
+            request = LookupRequest(" coalesced-did", mock_rucio, stream=True,
+                                    prefix='px:' if i else '')
+            results[i] = list(request.lookup_files())
+
+        threads = [threading.Thread(target=lookup, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        wait_for_readers(LookupRequest("coalesced-did", mock_rucio).flight_key(), 4)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        assert len(results[0]) == 3
+        assert results[0][0][0]['paths'][0] == 'root://a//ds0/f0'
+        for i in range(1, 4):
+            assert len(results[i]) == 3
+            assert results[i][0][0]['paths'][0] == 'px:root://a//ds0/f0'
+        assert mock_rucio.list_files_for_did.call_count == 1
+
+    def test_late_lookup_served_from_cache(self, mocker):
+        'A lookup too late to share the running one gets its result from the cache'
+        release = threading.Event()
+        cache = LRUCache()
+        mock_rucio = rucio_serves(mocker.MagicMock(RucioAdapter), dataset_chunks(3))
+        serve = mock_rucio.list_files_by_dataset.side_effect
+
+        def list_files_by_dataset(dss, did):
+            for i, chunk in enumerate(serve(dss, did)):
+                if i == 1:
+                    assert release.wait(5)
+                yield chunk
+
+        mock_rucio.list_files_by_dataset.side_effect = list_files_by_dataset
+        leader = LookupRequest("late-did", mock_rucio, stream=True, cache=cache).lookup_files()
+        assert len(next(leader)) == 2
+
+        results = []
+        follower = threading.Thread(target=lambda: results.extend(
+            LookupRequest("late-did", mock_rucio, cache=cache).lookup_files()))
+        follower.start()
+        release.set()
+        assert len(list(leader)) == 2
+        follower.join(5)
+        assert len(results[0]) == 6
+        assert mock_rucio.list_files_by_dataset.call_count == 1
+
+    def test_lookups_coalesced_error(self, mocker):
+        release = threading.Event()
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+
+        def list_files_for_did(did):
+            assert release.wait(5)
+            yield dataset_chunks(1)[0]
+            raise ValueError('Dataset is missing replicas')
+
+        mock_rucio.list_files_for_did.side_effect = list_files_for_did
+        errors = []
+
+        def lookup():
+            try:
+                list(LookupRequest("error-did", mock_rucio, stream=True).lookup_files())
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=lookup) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        wait_for_readers(LookupRequest("error-did", mock_rucio).flight_key(), 2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        assert [str(e) for e in errors] == ['Dataset is missing replicas'] * 2
+        assert mock_rucio.list_files_for_did.call_count == 1
+
+    def test_dataset_cache(self, mocker, monkeypatch):
+        'A container whose datasets are partly cached only resolves the new ones'
+        monkeypatch.setenv('CACHE_CHUNK_SIZE', '3')
+        cache = LRUCache()
+        chunks = dataset_chunks(6, n_files=2)
+        chunks[5] = chunks[5] * 3
+        mock_rucio = rucio_serves(mocker.MagicMock(RucioAdapter), chunks[:4])
+        list(LookupRequest("container1", mock_rucio, cache=cache).lookup_files())
+        assert isinstance(cache.get('dataset:scope:ds0'), list)
+
+        mock_rucio = rucio_serves(mocker.MagicMock(RucioAdapter), chunks)
+        result = list(LookupRequest("container2", mock_rucio, cache=cache).lookup_files())
+        assert len(result[0]) == 16
+        resolved = mock_rucio.resolved
+        assert resolved == [['scope', 'ds4'], ['scope', 'ds5']]
+        assert cache.get('dataset:scope:ds5')['chunks'] == 2
+
+        mock_rucio.reset_mock()
+        result = list(LookupRequest("container3", mock_rucio, cache=cache).lookup_files())
+        assert len(result[0]) == 16
+        mock_rucio.list_files_by_dataset.assert_not_called()
+
+    def test_datasets_resolved_while_expanding(self, mocker):
+        'Datasets are resolved a cache batch at a time while the DID is expanded'
+        cache = LRUCache()
+        n_datasets = DATASET_READ_BATCH + 20
+        mock_rucio = rucio_serves(mocker.MagicMock(RucioAdapter), dataset_chunks(n_datasets))
+        datasets = list(mock_rucio.expand_did('big-did'))
+        mock_rucio.resolved = []
+
+        def expand_did(did):
+            for i, ds in enumerate(datasets):
+                # The first batch is being resolved before the second is read
+                assert len(mock_rucio.resolved) == (0 if i < DATASET_READ_BATCH else
+                                                    DATASET_READ_BATCH)
+                yield ds
+
+        mock_rucio.expand_did.side_effect = expand_did
+        result = list(LookupRequest("big-did", mock_rucio, cache=cache).lookup_files())
+        assert len(result[0]) == 2 * n_datasets
+        assert len(mock_rucio.resolved) == n_datasets
+
+    def test_dataset_cache_skips_missing_replicas(self, mocker):
+        cache = LRUCache()
+        mock_rucio = rucio_serves(mocker.MagicMock(RucioAdapter), dataset_chunks(2))
+
+        def list_files_by_dataset(dss, did):
+            dss = list(dss)
+            yield dss[0], dataset_chunks(1)[0], 0
+            yield dss[1], dataset_chunks(1)[0], 1
+            raise ValueError('Dataset is missing replicas')
+
+        mock_rucio.list_files_by_dataset.side_effect = list_files_by_dataset
+        with pytest.raises(ValueError):
+            list(LookupRequest("partial-did", mock_rucio, cache=cache).lookup_files())
+        assert cache.get('dataset:scope:ds0') is not None
+        assert cache.get('dataset:scope:ds1') is None
+        assert cache.get('partial-did')['negative'] == 'missing_replicas'
+
+    def test_stale_cache_refreshed(self, mocker, monkeypatch):
+        monkeypatch.setenv('MEMCACHE_SOFT_TTL', '60')
+        cache = LRUCache()
+        mock_rucio = rucio_serves(mocker.MagicMock(RucioAdapter), dataset_chunks(2))
+        list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+        old_token = cache.get('my-did')['token']
+
+        # Fresh entries are served without going back to rucio
+        mock_rucio.reset_mock()
+        request = LookupRequest("my-did", mock_rucio, cache=cache)
+        assert len(list(request.lookup_files())[0]) == 4
+        assert not request.is_stale()
+        mock_rucio.expand_did.assert_not_called()
+
+        manifest = cache.get('my-did')
+        cache.set('my-did', dict(manifest, created=manifest['created'] - 120))
+        rucio_serves(mock_rucio, dataset_chunks(3))
+        request = LookupRequest("my-did", mock_rucio, cache=cache)
+        assert len(list(request.lookup_files())[0]) == 4
+        assert request.source == 'cache'
+        assert request.is_stale()
+
+        flight = FLIGHTS._flights.get(request.flight_key())
+        if flight is not None:
+            flight.wait()
+        # The refresh resolves every dataset again and replaces the entry
+        assert mock_rucio.resolved == \
+            [['scope', 'ds0'], ['scope', 'ds1'], ['scope', 'ds2']]
+        assert cache.get('my-did')['token'] != old_token
+        assert len(list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())[0]) == 6
+
+    def test_stale_hits_share_refresh(self, mocker, monkeypatch):
+        monkeypatch.setenv('MEMCACHE_SOFT_TTL', '60')
+        cache = LRUCache()
+        chunks = dataset_chunks(2)
+        mock_rucio = rucio_serves(mocker.MagicMock(RucioAdapter), chunks)
+        list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+        manifest = cache.get('my-did')
+        cache.set('my-did', dict(manifest, created=manifest['created'] - 120))
+
+        published = threading.Event()
+        release = threading.Event()
+
+        def slow_refresh(dss, did):
+            yield next(dss), chunks[0], 0
+            # The first chunk was published, with nobody reading it
+            published.set()
+            release.wait(5)
+            yield next(dss), chunks[1], 1
+
+        mock_rucio.reset_mock()
+        mock_rucio.list_files_by_dataset.side_effect = slow_refresh
+        request = LookupRequest("my-did", mock_rucio, cache=cache)
+        assert len(list(request.lookup_files())[0]) == 4
+        assert published.wait(5)
+        for _ in range(2):
+            request = LookupRequest("my-did", mock_rucio, cache=cache)
+            assert len(list(request.lookup_files())[0]) == 4
+            assert request.source == 'cache'
+
+        release.set()
+        flight = FLIGHTS._flights.get(request.flight_key())
+        if flight is not None:
+            flight.wait()
+        assert mock_rucio.list_files_by_dataset.call_count == 1
+        assert cache.get('my-did')['token'] != manifest['token']
+
+    def test_stale_refresh_failure_keeps_entry(self, mocker, monkeypatch):
+        monkeypatch.setenv('MEMCACHE_SOFT_TTL', '60')
+        cache = LRUCache()
+        mock_rucio = rucio_serves(mocker.MagicMock(RucioAdapter), dataset_chunks(2))
+        list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+        manifest = cache.get('my-did')
+        cache.set('my-did', dict(manifest, created=manifest['created'] - 120))
+
+        mock_rucio.expand_did.side_effect = OSError('rucio is down')
+        request = LookupRequest("my-did", mock_rucio, cache=cache)
+        assert len(list(request.lookup_files())[0]) == 4
+        flight = FLIGHTS._flights.get(request.flight_key())
+        if flight is not None:
+            with pytest.raises(OSError):
+                flight.wait()
+        assert cache.get('my-did')['token'] == manifest['token']
+
+    def test_stale_refresh_missing_replicas_keeps_entry(self, mocker, monkeypatch):
+        monkeypatch.setenv('MEMCACHE_SOFT_TTL', '60')
+        cache = LRUCache()
+        mock_rucio = rucio_serves(mocker.MagicMock(RucioAdapter), dataset_chunks(2))
+        list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+        manifest = cache.get('my-did')
+        cache.set('my-did', dict(manifest, created=manifest['created'] - 120))
+
+        def list_files_by_dataset(dss, did):
+            yield next(dss), dataset_chunks(1)[0], 1
+            raise ValueError(f'Dataset {did} is missing replicas for 1 of its files.')
+
+        mock_rucio.list_files_by_dataset.side_effect = list_files_by_dataset
+        request = LookupRequest("my-did", mock_rucio, cache=cache)
+        assert len(list(request.lookup_files())[0]) == 4
+        flight = FLIGHTS._flights.get(request.flight_key())
+        if flight is not None:
+            with pytest.raises(ValueError):
+                flight.wait()
+        assert mock_rucio.list_files_by_dataset.called
+        assert cache.get('my-did')['token'] == manifest['token']
+
+    def test_resume_from_checkpoints(self, mocker):
+        checkpoints = CheckpointStore(':memory:')
+        chunks = dataset_chunks(3)
+        mock_rucio = rucio_serves(mocker.MagicMock(RucioAdapter), chunks)
+
+        def interrupted(dss, did):
+            yield next(dss), chunks[0], 0
+            raise OSError('finder restarted')
+
+        mock_rucio.list_files_by_dataset.side_effect = interrupted
+        with pytest.raises(OSError):
+            list(LookupRequest("my-did", mock_rucio, request_id='req-1',
+                               checkpoints=checkpoints).lookup_files())
+        assert list(checkpoints.load('req-1', 'my-did')) == ['dataset:scope:ds0']
+
+        rucio_serves(mock_rucio, chunks)
+        result = list(LookupRequest("my-did", mock_rucio, request_id='req-1',
+                                    checkpoints=checkpoints).lookup_files())
+        assert len(result[0]) == 6
+        assert mock_rucio.resolved == \
+            [['scope', 'ds1'], ['scope', 'ds2']]
+        assert checkpoints.load('req-1', 'my-did') == {}
+
+    def test_lookup_traced_and_profiled(self, mocker, monkeypatch, tmp_path):
+        monkeypatch.setenv('PROFILE_DIR', str(tmp_path))
+        monkeypatch.setenv('PROFILE_THRESHOLD', '0')
+        mock_rucio = rucio_serves(mocker.MagicMock(RucioAdapter), dataset_chunks(2))
+        request = LookupRequest("my-did", mock_rucio, request_id='req-1', cache=LRUCache())
+        list(request.lookup_files())
+        assert request.trace.end_ns is not None
+        assert request.trace.attributes['n_files'] == 4
+        assert {'cache.read', 'resolve', 'cache.write'} <= set(request.trace.phases())
+        assert [p.name for p in tmp_path.iterdir()][0].startswith('req-1-')
+
+    @pytest.mark.parametrize('exists, outcome', [(False, 'not_found'), (True, 'empty')])
+    def test_negative_cache_no_files(self, mocker, exists, outcome):
+        cache = LRUCache()
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        mock_rucio.expand_did.side_effect = \
+            (lambda did: iter([])) if exists else DataIdentifierNotFound('bad-did')
+        assert list(LookupRequest("bad-did", mock_rucio, cache=cache).lookup_files()) == [[]]
+        assert cache.get('bad-did')['negative'] == outcome
+
+        mock_rucio.reset_mock()
+        request = LookupRequest("bad-did", mock_rucio, cache=cache)
+        assert list(request.lookup_files()) == [[]]
+        assert request.source == 'cache'
+        mock_rucio.expand_did.assert_not_called()
+
+    def test_negative_cache_missing_replicas(self, mocker):
+        cache = LRUCache()
+        mock_rucio = rucio_serves(mocker.MagicMock(RucioAdapter), dataset_chunks(1))
+
+        def list_files_by_dataset(dss, did):
+            yield next(dss), dataset_chunks(1)[0], 1
+            raise ValueError(f'Dataset {did} is missing replicas for 1 of its files.')
+
+        mock_rucio.list_files_by_dataset.side_effect = list_files_by_dataset
+        with pytest.raises(ValueError):
+            list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+
+        mock_rucio.reset_mock()
+        with pytest.raises(ValueError, match='missing replicas for 1 of its files'):
+            list(LookupRequest("my-did", mock_rucio, cache=cache).lookup_files())
+        mock_rucio.expand_did.assert_not_called()
+
+        # In stream mode the files that were found are replayed before the error
+        files = LookupRequest("my-did", mock_rucio, cache=cache, stream=True).lookup_files()
+        assert next(files) == dataset_chunks(1)[0]
+        with pytest.raises(ValueError, match='missing replicas'):
+            next(files)
+
+    def test_negative_cache_expiry(self, mocker):
+        'Negative entries kept longer than their TTL, e.g. by a near tier, are misses'
+        near = LRUCache()
+        cache = TieredCache(near, LRUCache(), near_ttl=300)
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        mock_rucio.expand_did.side_effect = DataIdentifierNotFound('bad-did')
+        list(LookupRequest("bad-did", mock_rucio, cache=cache).lookup_files())
+        near.delete('bad-did')
+        # Read from the far tier, which copies it to the near tier for 300 seconds
+        assert cache.get('bad-did')['negative'] == 'not_found'
+
+        now = time.time()
+        mocker.patch('servicex.did_finder.lookup_request.time.time', return_value=now + 61)
+        assert near.get('bad-did') is not None
+        request = LookupRequest("bad-did", mock_rucio, cache=cache)
+        assert request.cache_age() is None
+        list(request.lookup_files())
+        assert request.source == 'rucio'
+        assert mock_rucio.expand_did.call_count == 2
+
+    def test_negative_cache_disabled(self, mocker, monkeypatch):
+        monkeypatch.setenv('MEMCACHE_NEGATIVE_TTL', '0')
+        cache = LRUCache()
+        mock_rucio = mocker.MagicMock(RucioAdapter)
+        mock_rucio.expand_did.side_effect = DataIdentifierNotFound('bad-did')
+        list(LookupRequest("bad-did", mock_rucio, cache=cache).lookup_files())
+        assert cache.get('bad-did') is None
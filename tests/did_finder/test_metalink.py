@@ -0,0 +1,102 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import pytest
+
+from servicex.did_finder.metalink import parse_metalink
+
+METALINK = '''<?xml version="1.0" encoding="UTF-8"?>
+<metalink xmlns="urn:ietf:params:xml:ns:metalink">
+ <file name="f1.root">
+  <identity>user.me:f1.root</identity>
+  <hash type="md5">d41d8cd98f00b204e9800998ecf8427e</hash>
+  <hash type="adler32">0a1b2c3d</hash>
+  <size>100</size>
+  <glfn name="/atlas/rucio/user.me:f1.root"></glfn>
+  <url location="SITE_B" domain="wan" priority="2" client_extract="false">root://b//f1</url>
+  <url location="SITE_A" domain="wan" priority="1" client_extract="false">root://a//f1</url>
+ </file>
+ <file name="f2.root">
+  <parents>
+   <did>user.me:ds1</did>
+   <did>user.me:cont</did>
+  </parents>
+  <identity>user.me:f2.root</identity>
+  <hash type="adler32">ffffffff</hash>
+  <size>200</size>
+ </file>
+</metalink>
+'''
+
+
+class TestParseMetalink:
+    @pytest.mark.parametrize('chunk_size', [7, 100, 65536])
+    def test_parse(self, chunk_size):
+        records = list(parse_metalink(METALINK, chunk_size=chunk_size))
+        assert records == [
+            {
+                'identity': 'user.me:f1.root',
+                'adler32': '0a1b2c3d',
+                'size': 100,
+                'paths': ['root://a//f1', 'root://b//f1'],
+                'rses': ['SITE_A', 'SITE_B'],
+                'parents': []
+            },
+            {
+                'identity': 'user.me:f2.root',
+                'adler32': 'ffffffff',
+                'size': 200,
+                'paths': [],
+                'rses': [],
+                'parents': ['user.me:ds1', 'user.me:cont']
+            }
+        ]
+
+    def test_parse_bytes_chunks(self):
+        data = METALINK.encode('utf-8')
+        chunks = (data[i:i + 13] for i in range(0, len(data), 13))
+        assert [r['size'] for r in parse_metalink(chunks)] == [100, 200]
+
+    def test_records_are_streamed(self):
+        'The first file is available before the rest of the document is read'
+        head, tail = METALINK.split(' <file name="f2.root">')
+        fed = []
+
+        def source():
+            fed.append(head)
+            yield head
+            fed.append(tail)
+            yield ' <file name="f2.root">' + tail
+
+        records = parse_metalink(source())
+        assert next(records)['size'] == 100
+        assert len(fed) == 1
+
+    def test_empty(self):
+        doc = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+            '<metalink xmlns="urn:ietf:params:xml:ns:metalink">\n</metalink>\n'
+        assert list(parse_metalink(doc)) == []
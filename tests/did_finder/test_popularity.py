@@ -0,0 +1,74 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from servicex.did_finder.popularity import PopularityTracker
+
+
+class TestPopularityTracker:
+    def test_top(self, mocker):
+        now = mocker.patch('servicex.did_finder.popularity.time.time', return_value=1000.0)
+        tracker = PopularityTracker(half_life=100)
+        for _ in range(3):
+            tracker.record('old')
+        now.return_value = 1300.0
+        for did in ('a', 'b', 'a'):
+            tracker.record(did)
+        # 3 requests three half lives ago count less than 2 requests now
+        assert tracker.top(2) == ['a', 'b']
+        assert tracker.top(5) == ['a', 'b', 'old']
+
+    def test_save_load(self, tmp_path):
+        history_file = str(tmp_path / 'popularity.json')
+        tracker = PopularityTracker(history_file)
+        for did in ('a', 'b', 'b', 'c', 'c', 'c'):
+            tracker.record(did)
+        tracker.save(max_entries=2)
+
+        tracker = PopularityTracker(history_file)
+        tracker.load()
+        assert tracker.top(5) == ['c', 'b']
+
+    def test_shared_file(self, tmp_path):
+        'Processes sharing the file add up their counts'
+        history_file = str(tmp_path / 'popularity.json')
+        first = PopularityTracker(history_file)
+        other = PopularityTracker(history_file)
+        for did in ('a', 'a', 'b'):
+            first.record(did)
+        for did in ('b', 'b', 'c'):
+            other.record(did)
+        first.save()
+        other.save()
+        # Saving again does not count the same requests twice
+        other.save()
+        assert other.top(3) == ['b', 'a', 'c']
+
+        for _ in range(3):
+            first.record('c')
+        first.save()
+        assert first.top(3) == ['c', 'b', 'a']
+        assert round(first._scores['b'][0]) == 3
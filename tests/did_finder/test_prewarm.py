@@ -0,0 +1,118 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from servicex.did_finder.cache import LRUCache
+from servicex.did_finder.popularity import PopularityTracker
+from servicex.did_finder.prewarm import Prewarmer
+from servicex.did_finder.rucio_adapter import RucioAdapter
+from servicex.did_finder.rucio_calls import RucioCaller
+
+
+def mock_adapter(mocker):
+    'Adapter serving two datasets of two files for any DID, counting its calls'
+    adapter = mocker.MagicMock(RucioAdapter)
+    adapter.caller = RucioCaller()
+    chunks = [[{'adler32': '62b7c4b9', 'file_size': 1234, 'file_events': 0,
+                'paths': [f'root://a//ds{d}/f{f}']} for f in range(2)] for d in range(2)]
+
+    def expand_did(did):
+        adapter.caller.call('get_did', lambda: None)
+        yield from [[did, 'ds0'], [did, 'ds1']]
+
+    def list_files_by_dataset(dss, did):
+        adapter.resolved = []
+        for ds in dss:
+            adapter.resolved.append(ds)
+            adapter.caller.call('list_replicas', lambda: None)
+            yield ds, chunks[int(ds[1][2:])], 0
+
+    adapter.expand_did.side_effect = expand_did
+    adapter.list_files_by_dataset.side_effect = list_files_by_dataset
+    return adapter
+
+
+class TestPrewarmer:
+    def test_warms_watch_list_and_popular(self, mocker):
+        cache = LRUCache()
+        tracker = PopularityTracker()
+        for did in ('pop1', 'pop2', 'pop2', 'watched'):
+            tracker.record(did)
+        prewarmer = Prewarmer(mock_adapter(mocker), cache, watch_list=['watched'], top_n=1,
+                              tracker=tracker)
+        assert prewarmer.candidates() == ['watched', 'pop2']
+        assert prewarmer.run_once() == 2
+        assert cache.get('watched')['n_files'] == 4
+        assert cache.get('pop2')['n_files'] == 4
+        assert cache.get('pop1') is None
+
+    def test_renews_before_expiry(self, mocker, monkeypatch):
+        monkeypatch.setenv('MEMCACHE_TTL', '3600')
+        cache = LRUCache()
+        adapter = mock_adapter(mocker)
+        prewarmer = Prewarmer(adapter, cache, watch_list=['did'], lead=600,
+                              tracker=PopularityTracker())
+        assert prewarmer.run_once() == 1
+        # Fresh entries are left alone
+        assert prewarmer.run_once() == 0
+        token = cache.get('did')['token']
+
+        manifest = cache.get('did')
+        cache.set('did', dict(manifest, created=manifest['created'] - 3100))
+        assert prewarmer.run_once() == 1
+        assert cache.get('did')['token'] != token
+        # All datasets were resolved again, not taken from the dataset cache
+        assert adapter.resolved == [['did', 'ds0'], ['did', 'ds1']]
+
+    def test_budget(self, mocker):
+        cache = LRUCache()
+        prewarmer = Prewarmer(mock_adapter(mocker), cache, watch_list=['a', 'b', 'c'],
+                              budget=4, tracker=PopularityTracker())
+        # Each DID takes 3 calls, the round stops in the middle of the second
+        assert prewarmer.run_once() == 1
+        assert prewarmer.rucio_adapter.caller.calls == 4
+        assert cache.get('b') is None
+        assert cache.get('c') is None
+
+        # The next round has a budget of its own
+        assert prewarmer.run_once() == 1
+        assert cache.get('b') is not None
+
+    def test_failures_do_not_stop_the_round(self, mocker):
+        cache = LRUCache()
+        adapter = mock_adapter(mocker)
+        expand_did = adapter.expand_did.side_effect
+
+        def failing(did):
+            if did == 'bad':
+                raise OSError('rucio is down')
+            return expand_did(did)
+
+        adapter.expand_did.side_effect = failing
+        prewarmer = Prewarmer(adapter, cache, watch_list=['bad', 'good'],
+                              tracker=PopularityTracker())
+        assert prewarmer.run_once() == 1
+        assert cache.get('good') is not None
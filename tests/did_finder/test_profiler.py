@@ -0,0 +1,93 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+
+from servicex.did_finder.profiler import LookupProfiler, LookupSampler
+from servicex.did_finder.tracing import attach, bind, span, start_trace
+
+
+def busy_wait(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def other_busy_wait(stop):
+    busy_wait(stop)
+
+
+class TestProfiler:
+    def test_samples_threads_of_each_lookup(self, tmp_path):
+        sampler = LookupSampler(interval=0.001)
+        lookup, other = start_trace('lookup'), start_trace('lookup')
+        stop = threading.Event()
+
+        def work(trace, fn):
+            with attach(trace):
+                fn(stop)
+
+        workers = [threading.Thread(target=work, args=(lookup, busy_wait), name='busy'),
+                   threading.Thread(target=work, args=(other, other_busy_wait), name='other'),
+                   threading.Thread(target=busy_wait, args=(stop,), name='untraced')]
+        sampler.add(lookup)
+        sampler.add(other)
+        for worker in workers:
+            worker.start()
+        while not (sampler._lookups[id(lookup)] and sampler._lookups[id(other)]):
+            stop.wait(0.01)
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+        stacks = sampler.remove(lookup)
+        assert all(stack.startswith('busy;') for stack in stacks)
+        assert 'busy_wait (test_profiler.py:' in next(iter(stacks))
+        assert all(count > 0 for count in stacks.values())
+        assert all(stack.startswith('other;') for stack in sampler.remove(other))
+        assert sampler.remove(lookup) == {}
+
+    def test_bound_threads_are_sampled(self):
+        sampler = LookupSampler(interval=0.001)
+        lookup = start_trace('lookup')
+        stop = threading.Event()
+        sampler.add(lookup)
+        with span('resolve', parent=lookup):
+            worker = threading.Thread(target=bind(busy_wait), args=(stop,), name='rucio')
+        worker.start()
+        while not sampler._lookups[id(lookup)]:
+            stop.wait(0.01)
+        stop.set()
+        worker.join()
+        assert all(stack.startswith('rucio;') for stack in sampler.remove(lookup))
+
+    def test_only_slow_lookups_are_kept(self, tmp_path, monkeypatch):
+        assert LookupProfiler.for_lookup(start_trace('lookup')) is None
+        monkeypatch.setenv('PROFILE_DIR', str(tmp_path / 'profiles'))
+        monkeypatch.setenv('PROFILE_THRESHOLD', '10')
+        assert LookupProfiler.for_lookup(start_trace('lookup')).finish('fast', 1.0) is None
+        path = LookupProfiler.for_lookup(start_trace('lookup')).finish('slow', 11.0)
+        assert path == str(tmp_path / 'profiles' / 'slow.folded')
@@ -0,0 +1,99 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+
+from servicex.did_finder.replica_ranking import ExcludeRSEs, ReplicaRanker, RSEHistory, \
+    SitePreference, create_ranker
+
+
+def record(*rses, size=1000):
+    return {
+        'identity': 'scope:f1',
+        'size': size,
+        'paths': [f'root://{rse.lower()}//f1' for rse in rses],
+        'rses': list(rses)
+    }
+
+
+class TestReplicaRanking:
+    def test_no_policies(self):
+        assert create_ranker() is None
+        ranker = ReplicaRanker()
+        assert ranker.rank(record('A', 'B', 'C')) == \
+            ['root://a//f1', 'root://b//f1', 'root://c//f1']
+
+    def test_site_preference(self):
+        ranker = ReplicaRanker([SitePreference(['C', 'B'])])
+        assert ranker.rank(record('A', 'B', 'C', 'D')) == \
+            ['root://c//f1', 'root://b//f1', 'root://a//f1', 'root://d//f1']
+
+    def test_exclude_and_cap(self):
+        exclude = ExcludeRSEs(['A'])
+        ranker = ReplicaRanker([exclude], max_replicas=1)
+        assert ranker.rank(record('A', 'B', 'C')) == ['root://b//f1']
+        exclude.update(['B'])
+        assert ranker.rank(record('A', 'B', 'C')) == ['root://a//f1']
+
+    def test_exclude_all_keeps_replicas(self):
+        ranker = ReplicaRanker([ExcludeRSEs(['A', 'B'])])
+        assert ranker.rank(record('A', 'B')) == ['root://a//f1', 'root://b//f1']
+
+    def test_history(self):
+        history = RSEHistory()
+        history.record('A', 0.5)
+        history.record('A', 2.0, n_bytes=1000)
+        history.record('B', 0.1)
+        history.record('B', 1.0, n_bytes=1000)
+        ranker = ReplicaRanker([history])
+        assert ranker.rank(record('A', 'B')) == ['root://b//f1', 'root://a//f1']
+        # Failures make an RSE less attractive
+        for _ in range(10):
+            history.record('B', 0.1, ok=False)
+        assert ranker.rank(record('A', 'B')) == ['root://a//f1', 'root://b//f1']
+
+    def test_history_unknown_rse_is_typical(self):
+        history = RSEHistory()
+        history.record('FAST', 0.1)
+        history.record('MEDIUM', 1.0)
+        history.record('SLOW', 10.0)
+        ranker = ReplicaRanker([history])
+        assert ranker.rank(record('SLOW', 'NEW', 'FAST')) == \
+            ['root://fast//f1', 'root://new//f1', 'root://slow//f1']
+
+    def test_history_stats_file(self, tmp_path):
+        stats_file = tmp_path / 'rse_stats.json'
+        history = RSEHistory(str(stats_file))
+        history.record('A', 2.0)
+        history.record('B', 1.0)
+        history.save()
+        assert set(json.loads(stats_file.read_text())) == {'A', 'B'}
+
+        stats_file.write_text(json.dumps({'A': {'latency': 0.1}, 'B': {'latency': 5.0}}))
+        ranker = create_ranker(stats_file=str(stats_file))
+        ranker.refresh()
+        assert ranker.rank(record('B', 'A')) == ['root://a//f1', 'root://b//f1']
@@ -0,0 +1,260 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+
+import pytest
+from rucio.common.exception import DataIdentifierNotFound
+
+from servicex.did_finder.replica_ranking import create_ranker
+from servicex.did_finder.rucio_adapter import RucioAdapter
+
+
+def metalink(files):
+    'Build a metalink document like the one rucio returns for `list_replicas`'
+    body = ''
+    for name, urls, *parents in files:
+        body += f' <file name="{name}">\n'
+        if parents:
+            body += '  <parents>\n'
+            body += ''.join(f'   <did>{p}</did>\n' for p in parents)
+            body += '  </parents>\n'
+        body += f'  <identity>scope:{name}</identity>\n'
+        body += '  <hash type="adler32">62b7c4b9</hash>\n'
+        body += '  <size>1234</size>\n'
+        for i, url in enumerate(urls):
+            body += f'  <url location="SITE{i}" domain="wan" priority="{i + 1}" ' \
+                    f'client_extract="false">{url}</url>\n'
+        body += ' </file>\n'
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' \
+        '<metalink xmlns="urn:ietf:params:xml:ns:metalink">\n' + body + '</metalink>\n'
+
+
+def ds_files(ds_name, n_files=2, n_replicas=2):
+    return [
+        (f'{ds_name}.f{i}', [f'root://site{r}.org//{ds_name}/f{i}' for r in range(n_replicas)],
+         f'scope:{ds_name}', 'scope:container')
+        for i in range(n_files)
+    ]
+
+
+def ds_metalink(*ds_names):
+    return metalink([f for ds_name in ds_names for f in ds_files(ds_name)])
+
+
+def container_adapter(mocker, n_datasets, **kwargs):
+    did_client = mocker.MagicMock()
+    did_client.get_did.return_value = {'type': 'CONTAINER', 'length': n_datasets}
+    did_client.list_content.return_value = [
+        {'scope': 'scope', 'name': f'ds{i}'} for i in range(n_datasets)
+    ]
+    replica_client = mocker.MagicMock()
+    replica_client.list_replicas.side_effect = \
+        lambda dids, **kw: ds_metalink(*[d['name'] for d in dids])
+    return RucioAdapter(did_client, replica_client, **kwargs)
+
+
+class TestRucioAdapter:
+    def test_list_files_for_dataset(self, mocker):
+        adapter = container_adapter(mocker, 1)
+        files, no_replica = adapter.list_files_for_dataset(['scope', 'ds0'])
+        assert no_replica == 0
+        assert files.to_dicts() == [
+            {
+                'adler32': '62b7c4b9',
+                'file_size': 1234,
+                'file_events': 0,
+                'paths': [f'root://site0.org//ds0/f{i}', f'root://site1.org//ds0/f{i}']
+            } for i in range(2)
+        ]
+
+    def test_list_files_ranked(self, mocker):
+        adapter = container_adapter(mocker, 1, ranker=create_ranker(prefer_rses=['SITE1'],
+                                                                    max_replicas=1))
+        files, _ = adapter.list_files_for_dataset(['scope', 'ds0'])
+        assert [af['paths'] for af in files.to_dicts()] == \
+            [[f'root://site1.org//ds0/f{i}'] for i in range(2)]
+
+    def test_list_files_for_did_serial(self, mocker):
+        adapter = container_adapter(mocker, 5)
+        chunks = list(adapter.list_files_for_did('scope:container'))
+        assert len(chunks) == 5
+        assert adapter.replica_client.list_replicas.call_count == 5
+
+    @pytest.mark.parametrize('threads', [2, 4, 16])
+    def test_list_files_for_did_concurrent(self, mocker, threads):
+        adapter = container_adapter(mocker, 20, threads=threads)
+        chunks = list(adapter.list_files_for_did('scope:container'))
+        assert len(chunks) == 20
+        paths = sorted(p for c in chunks for f in c for p in f['paths'])
+        assert len(paths) == 20 * 2 * 2
+        assert len(set(paths)) == len(paths)
+
+    def test_list_files_for_did_concurrent_overlaps(self, mocker):
+        'Lookups of different datasets really run at the same time'
+        adapter = container_adapter(mocker, 4, threads=4)
+        barrier = threading.Barrier(4, timeout=5)
+
+        def list_replicas(dids, **kw):
+            barrier.wait()
+            return ds_metalink(dids[0]['name'])
+
+        adapter.replica_client.list_replicas.side_effect = list_replicas
+        assert len(list(adapter.list_files_for_did('scope:container'))) == 4
+
+    @pytest.mark.parametrize('threads', [1, 3])
+    def test_missing_replicas_raised_at_end(self, mocker, threads):
+        adapter = container_adapter(mocker, 3, threads=threads)
+
+        def list_replicas(dids, **kw):
+            if dids[0]['name'] == 'ds1':
+                return metalink([('ds1.f0', [])])
+            return ds_metalink(*[d['name'] for d in dids])
+
+        adapter.replica_client.list_replicas.side_effect = list_replicas
+        chunks = []
+        with pytest.raises(ValueError, match='missing replicas for 1 of its files'):
+            for c in adapter.list_files_for_did('scope:container'):
+                chunks.append(c)
+        assert len(chunks) == 3
+
+    @pytest.mark.parametrize('threads', [1, 3])
+    @pytest.mark.parametrize('batch_size', [2, 5, 50])
+    def test_list_files_for_did_batched(self, mocker, threads, batch_size):
+        adapter = container_adapter(mocker, 10, threads=threads, batch_size=batch_size)
+        chunks = list(adapter.list_files_for_did('scope:container'))
+        assert adapter.replica_client.list_replicas.call_count == -(-10 // batch_size)
+        assert len(chunks) == 10
+        for chunk in chunks:
+            assert len(chunk) == 2
+            ds = chunk.to_dicts()[0]['paths'][0].split('/')[3]
+            assert all(p.split('/')[3] == ds for f in chunk for p in f['paths'])
+
+    def test_list_files_for_datasets_demultiplex(self, mocker):
+        adapter = container_adapter(mocker, 0)
+        adapter.replica_client.list_replicas.side_effect = None
+        adapter.replica_client.list_replicas.return_value = metalink([
+            ('a.f0', ['root://s//a/f0'], 'scope:a'),
+            ('b.f0', ['root://s//b/f0'], 'scope:container', 'scope:b'),
+            ('b.f1', [], 'scope:b'),
+            ('a.f1', ['root://s//a/f1'], 'scope:a'),
+        ])
+        result = adapter.list_files_for_datasets([['scope', 'a'], ['scope', 'b']])
+        assert [[f['paths'][0] for f in files] for files, _ in result] == \
+            [['root://s//a/f0', 'root://s//a/f1'], ['root://s//b/f0']]
+        assert [no_replicas for _, no_replicas in result] == [0, 1]
+        kwargs = adapter.replica_client.list_replicas.call_args[1]
+        assert kwargs['resolve_parents']
+
+    def test_list_files_for_datasets_without_parents(self, mocker):
+        'A batch whose files do not name their dataset is looked up one dataset at a time'
+        adapter = container_adapter(mocker, 0)
+
+        def list_replicas(dids, **kw):
+            names = [d['name'] for d in dids]
+            return metalink([(f'{n}.f0', [f'root://s//{n}/f0']) for n in names])
+
+        adapter.replica_client.list_replicas.side_effect = list_replicas
+        result = adapter.list_files_for_datasets([['scope', 'a'], ['scope', 'b']])
+        assert [[f['paths'][0] for f in files] for files, _ in result] == \
+            [['root://s//a/f0'], ['root://s//b/f0']]
+        assert adapter.replica_client.list_replicas.call_count == 3
+
+    @pytest.mark.parametrize('threads', [1, 4])
+    def test_nested_containers(self, mocker, threads):
+        adapter = container_adapter(mocker, 0, threads=threads)
+        content = {
+            'container': [{'scope': 'scope', 'name': 'ds0', 'type': 'DATASET'},
+                          {'scope': 'scope', 'name': 'sub1', 'type': 'CONTAINER'},
+                          {'scope': 'scope', 'name': 'sub2', 'type': 'CONTAINER'}],
+            'sub1': [{'scope': 'scope', 'name': 'ds1', 'type': 'DATASET'},
+                     {'scope': 'scope', 'name': 'sub2', 'type': 'CONTAINER'}],
+            'sub2': [{'scope': 'scope', 'name': 'ds1', 'type': 'DATASET'},
+                     {'scope': 'scope', 'name': 'ds2', 'type': 'DATASET'}],
+        }
+        adapter.did_client.list_content.side_effect = lambda scope, name: content[name]
+        datasets = adapter.list_datasets_for_did('scope:container')
+        assert sorted(datasets) == [['scope', 'ds0'], ['scope', 'ds1'], ['scope', 'ds2']]
+        assert adapter.did_client.list_content.call_count == 3
+
+        files = [f for t in adapter.list_files_for_did('scope:container') for f in t]
+        assert len(files) == 6
+
+    def test_nested_containers_depth_limit(self, mocker):
+        adapter = container_adapter(mocker, 0, max_depth=2)
+        adapter.did_client.list_content.side_effect = lambda scope, name: [
+            {'scope': 'scope', 'name': f'{name}.ds', 'type': 'DATASET'},
+            {'scope': 'scope', 'name': f'{name}.c', 'type': 'CONTAINER'}]
+        assert adapter.list_datasets_for_did('scope:c') == \
+            [['scope', 'c.ds'], ['scope', 'c.c.ds'], ['scope', 'c.c.c.ds']]
+
+    @pytest.mark.parametrize('threads', [1, 2])
+    def test_replicas_resolved_while_expanding(self, mocker, threads):
+        adapter = container_adapter(mocker, 0, threads=threads)
+        first_resolved = threading.Event()
+        list_replicas = adapter.replica_client.list_replicas.side_effect
+
+        def list_content(scope, name):
+            if name == 'container':
+                return [{'scope': 'scope', 'name': 'ds0', 'type': 'DATASET'},
+                        {'scope': 'scope', 'name': 'sub', 'type': 'CONTAINER'}]
+            # The datasets found so far are looked up before this returns
+            assert first_resolved.wait(5)
+            return [{'scope': 'scope', 'name': 'ds1', 'type': 'DATASET'}]
+
+        def resolve(dids, **kw):
+            first_resolved.set()
+            return list_replicas(dids, **kw)
+
+        adapter.did_client.list_content.side_effect = list_content
+        adapter.replica_client.list_replicas.side_effect = resolve
+        assert len(list(adapter.list_files_for_did('scope:container'))) == 2
+
+    def test_list_files_for_did_not_found(self, mocker):
+        adapter = container_adapter(mocker, 2)
+        adapter.did_client.get_did.side_effect = DataIdentifierNotFound('scope:nope')
+        assert list(adapter.list_files_for_did('scope:nope')) == []
+        assert adapter.list_datasets_for_did('scope:nope') is None
+
+    def test_list_files_for_did_dataset_gone(self, mocker):
+        adapter = container_adapter(mocker, 2)
+        adapter.replica_client.list_replicas.side_effect = \
+            DataIdentifierNotFound('scope:ds0')
+        with pytest.raises(DataIdentifierNotFound):
+            list(adapter.list_files_for_did('scope:container'))
+
+    def test_logical_files_skip_replicas(self, mocker):
+        adapter = container_adapter(mocker, 2, report_logical_files=True)
+        adapter.did_client.list_files.side_effect = lambda scope, name: iter([
+            {'scope': 'cms', 'name': f'/store/{name}/f{i}.root', 'bytes': 1234,
+             'adler32': '62b7c4b9', 'events': None} for i in range(3)
+        ])
+        chunks = list(adapter.list_files_for_did('cms:container'))
+        assert [af['paths'] for af in chunks[0].to_dicts()] == \
+            [[f'/store/ds0/f{i}.root'] for i in range(3)]
+        assert chunks[1].to_dicts()[0]['file_size'] == 1234
+        adapter.replica_client.list_replicas.assert_not_called()
@@ -0,0 +1,126 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+
+import pytest
+from rucio.common.exception import DataIdentifierNotFound, ServiceUnavailable
+
+from servicex.did_finder.rucio_calls import AIMDLimiter, BudgetExceeded, RucioCaller
+
+
+class TestRucioCaller:
+    def test_retries_transient_errors(self, mocker):
+        sleep = mocker.patch('servicex.did_finder.rucio_calls.time.sleep')
+        fn = mocker.Mock(side_effect=[ServiceUnavailable('503'), TimeoutError(), 'ok'])
+        assert RucioCaller(retries=3).call('get_did', fn, 'scope', 'name') == 'ok'
+        assert fn.call_count == 3
+        fn.assert_called_with('scope', 'name')
+        assert sleep.call_count == 2
+        # The backoff grows, with jitter
+        assert 0 <= sleep.call_args_list[0][0][0] <= 0.5
+        assert 0 <= sleep.call_args_list[1][0][0] <= 1.0
+
+    def test_gives_up_after_retries(self, mocker):
+        mocker.patch('servicex.did_finder.rucio_calls.time.sleep')
+        fn = mocker.Mock(side_effect=ServiceUnavailable('503'))
+        with pytest.raises(ServiceUnavailable):
+            RucioCaller(retries=2).call('get_did', fn)
+        assert fn.call_count == 3
+
+    def test_answers_are_not_retried(self, mocker):
+        fn = mocker.Mock(side_effect=DataIdentifierNotFound('scope:name'))
+        caller = RucioCaller()
+        with pytest.raises(DataIdentifierNotFound):
+            caller.call('get_did', fn)
+        assert fn.call_count == 1
+        assert caller.limiter('get_did').limit > 8
+
+    def test_deadline(self, mocker):
+        sleep = mocker.patch('servicex.did_finder.rucio_calls.time.sleep')
+        mocker.patch('servicex.did_finder.rucio_calls.random.uniform', return_value=2.0)
+        fn = mocker.Mock(side_effect=ServiceUnavailable('503'))
+        with pytest.raises(ServiceUnavailable):
+            RucioCaller(retries=5, deadline=1).call('get_did', fn)
+        assert fn.call_count == 1
+        sleep.assert_not_called()
+
+    def test_budget(self, mocker):
+        mocker.patch('servicex.did_finder.rucio_calls.time.sleep')
+        fn = mocker.Mock(side_effect=[ServiceUnavailable('503'), 'ok', 'ok'])
+        caller = RucioCaller()
+        caller.max_calls = 2
+        # Retries count against the budget
+        assert caller.call('get_did', fn) == 'ok'
+        with pytest.raises(BudgetExceeded):
+            caller.call('get_did', fn)
+        assert fn.call_count == 2
+        assert caller.limiter('get_did').in_flight == 0
+
+
+class TestAIMDLimiter:
+    def test_additive_increase_multiplicative_decrease(self):
+        limiter = AIMDLimiter('test', limit=4, max_limit=6, latency_target=1)
+        for _ in range(8):
+            assert limiter.acquire()
+            limiter.release(0.1)
+        assert 5 < limiter.limit < 6
+        assert limiter.acquire()
+        limiter.release(0.1, ok=False)
+        assert 2.5 < limiter.limit < 3
+        # A slow call from before the decrease does not halve it again
+        assert limiter.acquire()
+        limiter.release(5.0)
+        assert 2.5 < limiter.limit < 3
+
+    def test_limits_concurrency(self):
+        limiter = AIMDLimiter('test', limit=2)
+        assert limiter.acquire()
+        assert limiter.acquire()
+        assert not limiter.acquire(timeout=0.01)
+
+        acquired = threading.Event()
+
+        def waiter():
+            limiter.acquire()
+            acquired.set()
+
+        threading.Thread(target=waiter).start()
+        assert not acquired.wait(0.05)
+        limiter.release(0.1)
+        assert acquired.wait(5)
+
+    def test_bounds(self):
+        limiter = AIMDLimiter('test', limit=1, min_limit=1, max_limit=2)
+        for _ in range(5):
+            limiter.acquire()
+            limiter.release(0.1, ok=False)
+        assert limiter.limit == 1
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release(0.1)
+        assert limiter.limit == 2
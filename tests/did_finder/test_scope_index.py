@@ -0,0 +1,110 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import json
+import time
+
+from servicex.did_finder.scope_index import ScopeIndex
+
+SCOPES = ['user.kchoi', 'user.kc', 'data18_13TeV', 'mc16_13TeV', 'user']
+
+
+def scope_client(mocker, scopes=SCOPES):
+    client = mocker.MagicMock()
+    client.list_scopes.return_value = list(scopes)
+    return client
+
+
+class TestScopeIndex:
+    def test_find(self, mocker):
+        index = ScopeIndex(scope_client(mocker))
+        assert index.find('user.kchoi.ttHML_80fb_ttZ') == 'user.kchoi'
+        assert index.find('user.kc.ds') == 'user.kc'
+        assert index.find('user.other.ds') == 'user'
+        assert index.find('data18_13TeV.00348885.physics_Main') == 'data18_13TeV'
+        assert index.find('data17_13TeV.00348885.physics_Main') is None
+        assert index.find('user.kchoi') == 'user.kchoi'
+
+    def test_scopes_listed_once(self, mocker):
+        client = scope_client(mocker)
+        index = ScopeIndex(client)
+        index.find('user.kchoi.a')
+        index.find('user.kchoi.b')
+        assert client.list_scopes.call_count == 1
+
+    def test_client_timeout(self, mocker):
+        client_class = mocker.patch('servicex.did_finder.scope_index.ScopeClient',
+                                    return_value=scope_client(mocker))
+        assert ScopeIndex(timeout=30).find('user.kc.ds') == 'user.kc'
+        client_class.assert_called_once_with(timeout=30)
+
+    def test_cache_file(self, mocker, tmp_path):
+        cache_file = str(tmp_path / 'scopes.json')
+        ScopeIndex(scope_client(mocker), cache_file=cache_file).find('user.kchoi.a')
+        assert sorted(json.load(open(cache_file))['scopes']) == sorted(SCOPES)
+
+        client = scope_client(mocker)
+        index = ScopeIndex(client, cache_file=cache_file)
+        assert index.find('mc16_13TeV.123') == 'mc16_13TeV'
+        client.list_scopes.assert_not_called()
+
+    def test_bad_cache_file(self, mocker, tmp_path):
+        cache_file = tmp_path / 'scopes.json'
+        cache_file.write_text('not json')
+        client = scope_client(mocker)
+        index = ScopeIndex(client, cache_file=str(cache_file))
+        assert index.find('mc16_13TeV.123') == 'mc16_13TeV'
+        client.list_scopes.assert_called_once()
+
+    def test_background_refresh(self, mocker):
+        client = scope_client(mocker)
+        index = ScopeIndex(client, refresh_interval=0.01)
+        assert index.find('data22_13p6TeV.1') is None
+
+        client.list_scopes.return_value = SCOPES + ['data22_13p6TeV']
+        deadline = time.time() + 5
+        while index.find('data22_13p6TeV.1') is None and time.time() < deadline:
+            time.sleep(0.01)
+        index.stop()
+        assert index.find('data22_13p6TeV.1') == 'data22_13p6TeV'
+
+    def test_follow_cache_file(self, mocker, tmp_path):
+        cache_file = str(tmp_path / 'scopes.json')
+        ScopeIndex(scope_client(mocker), cache_file=cache_file).find('user.kchoi.a')
+        client = scope_client(mocker)
+        index = ScopeIndex(client, cache_file=cache_file, refresh_interval=0.01, follow=True)
+        assert index.find('data22_13p6TeV.1') is None
+
+        # Another process refreshes the file
+        ScopeIndex(scope_client(mocker, SCOPES + ['data22_13p6TeV']),
+                   cache_file=cache_file).refresh()
+        deadline = time.time() + 5
+        while index.find('data22_13p6TeV.1') is None and time.time() < deadline:
+            time.sleep(0.01)
+        index.stop()
+        assert index.find('data22_13p6TeV.1') == 'data22_13p6TeV'
+        client.list_scopes.assert_not_called()
@@ -0,0 +1,84 @@
+# Copyright (c) 2019, IRIS-HEP
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+from concurrent.futures import ThreadPoolExecutor
+
+from servicex.did_finder import tracing
+from servicex.did_finder.tracing import bind, span, start_trace
+
+
+class TestTracing:
+    def test_spans_nest(self):
+        root = start_trace('lookup', did='scope:name')
+        with span('resolve', parent=root) as resolve:
+            with span('rucio.get_did') as call:
+                assert call.parent is resolve
+            with span('datasets', datasets='scope:ds0'):
+                pass
+        root.end()
+        assert [s.name for s in root.spans] == ['lookup', 'resolve', 'rucio.get_did', 'datasets']
+        assert all(s.end_ns >= s.start_ns for s in root.spans)
+        assert set(root.phases()) == {'resolve', 'rucio.get_did', 'datasets'}
+
+    def test_no_parent_is_not_recorded(self):
+        with span('rucio.get_did') as call:
+            assert call is None
+
+    def test_bind_to_other_threads(self):
+        root = start_trace('lookup')
+
+        def work(i):
+            with span('datasets', i=i) as s:
+                return s.parent if s else None
+
+        with span('resolve', parent=root) as resolve:
+            with ThreadPoolExecutor(2) as executor:
+                futures = [executor.submit(bind(work), i) for i in range(4)]
+                parents = [f.result() for f in futures]
+            assert parents == [resolve] * 4
+        # Without binding, the executor threads do not see the span
+        with span('resolve', parent=root):
+            with ThreadPoolExecutor(2) as executor:
+                assert executor.submit(work, 0).result() is None
+        root.end()
+
+    def test_export(self, mocker):
+        tracer = mocker.MagicMock()
+        otel_trace = mocker.MagicMock()
+        otel_trace.set_span_in_context.side_effect = lambda s: ('ctx', s)
+        mocker.patch.object(tracing, '_otel_tracer', tracer)
+        mocker.patch.object(tracing, 'otel_trace', otel_trace)
+        root = start_trace('lookup', did='scope:name', source=None)
+        with span('resolve', parent=root):
+            pass
+        root.end()
+        names = [c[0][0] for c in tracer.start_span.call_args_list]
+        assert names == ['lookup', 'resolve']
+        first, second = tracer.start_span.call_args_list
+        assert first[1]['context'] is None
+        assert first[1]['attributes'] == {'did': 'scope:name'}
+        assert second[1]['context'] == ('ctx', tracer.start_span.return_value)